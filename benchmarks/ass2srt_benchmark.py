@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+## Micro-benchmark of the ASS/SSA to SRT conversion of transcode2H265.py.
+##
+## Writes a synthetic karaoke-like ASS file with the given number of events (override tags, commas
+## in the text, duplicated layers and signs repeated frame by frame) and times its conversion.
+##
+## Usage: python3 benchmarks/ass2srt_benchmark.py [events] [repetitions]
+##
+
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import transcode2H265
+
+def ass_time(centiseconds):
+    seconds,centiseconds=divmod(centiseconds,100)
+    minutes,seconds=divmod(seconds,60)
+    hours,minutes=divmod(minutes,60)
+    return '{:d}:{:02d}:{:02d}.{:02d}'.format(hours,minutes,seconds,centiseconds)
+
+def write_ass_file(filename,events):
+    with open(filename,'w',encoding='utf-8') as ass_file:
+        ass_file.write('[Script Info]\nScriptType: v4.00+\n\n[V4+ Styles]\nFormat: Name, Fontname, Fontsize\nStyle: Default,Arial,20\n\n')
+        ass_file.write('[Events]\nFormat: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text\n')
+        for counter in range(events):
+            start=counter*50
+            kind=counter%4
+            if kind == 0: # Karaoke line, with commas in the text.
+                text='{\\k20}Line '+str(counter)+', {\\k30}sung{\\k25}, slowly\\Nsecond line'
+
+            elif kind == 1: # The same line in two layers.
+                text='{\\bord3\\blur2}Shadowed line'
+                ass_file.write('Dialogue: 1,{},{},Default,,0,0,0,,{}\n'.format(ass_time(start),ass_time(start+45),text))
+
+            elif kind == 2: # A sign typeset frame by frame, overlapping the previous one.
+                ass_file.write('Dialogue: 0,{},{},Default,,0,0,0,,{}\n'.format(ass_time(start),ass_time(start+200),'{\\pos(320,50)\\fad(100,0)}Sign'))
+                continue
+
+            else: # A drawing, that must be removed.
+                text='{\\p1}m 0 0 l 100 0 100 100 0 100{\\p0}'
+
+            ass_file.write('Dialogue: 0,{},{},Default,,0,0,0,,{}\n'.format(ass_time(start),ass_time(start+45),text))
+
+def main():
+    events=int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    repetitions=int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    with tempfile.TemporaryDirectory() as directory:
+        ass_filename=os.path.join(directory,'benchmark.ass')
+        srt_filename=os.path.join(directory,'benchmark.srt')
+        write_ass_file(ass_filename,events)
+        timings=[]
+        for repetition in range(repetitions):
+            start_time=time.perf_counter()
+            transcode2H265.ass2srt(ass_filename,srt_filename)
+            timings.append(time.perf_counter()-start_time)
+
+        with open(srt_filename,encoding='utf-8') as srt_file:
+            srt_events=sum(1 for line in srt_file if ' --> ' in line)
+
+    best=min(timings)
+    print('{:d} ASS events -> {:d} SRT events'.format(events,srt_events))
+    print('best {:.3f} s, mean {:.3f} s over {:d} runs ({:.0f} events/s)'.format(best,sum(timings)/len(timings),repetitions,events/best))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+## Benchmark of the startup time of transcode2H265.py.
+##
+## Runs the script, in new Python processes, just to import it and for the invocations that do no
+## work (-v, -h and wrong arguments), which must not run any external program, and times them.
+## If a maximum is given, it exits with an error when the median of any of them is slower, so it
+## can guard against regressions. As the whole process times are noisy on a busy machine, the time
+## the import itself takes, as reported by python -X importtime, and the number of modules it loads
+## are also given.
+##
+## Usage: python3 benchmarks/startup_benchmark.py [repetitions] [maximum milliseconds]
+##
+
+import os
+import subprocess
+import sys
+import time
+
+script=os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','transcode2H265.py')
+
+cases=[('python only',[sys.executable,'-c','pass']),
+       ('import',[sys.executable,'-c','import sys; sys.path.insert(0,sys.argv[1]); import transcode2H265',os.path.dirname(script)]),
+       ('-v',[sys.executable,script,'-v']),
+       ('-h',[sys.executable,script,'-h']),
+       ('wrong arguments',[sys.executable,script,'--crf','100','video.mkv'])]
+
+import_cmd=[sys.executable,'-X','importtime','-c','import sys; sys.path.insert(0,sys.argv[1]); import transcode2H265; print(len(sys.modules))',os.path.dirname(script)]
+
+def time_import(repetitions):
+    """Returns the best and median cumulative import times of the script, and the number of modules loaded once it is imported.
+    """
+    timings=[]
+    for repetition in range(repetitions):
+        result=subprocess.run(import_cmd,stdout=subprocess.PIPE,stderr=subprocess.PIPE,universal_newlines=True)
+        for line in result.stderr.splitlines():
+            fields=line.split('|')
+            if len(fields) == 3 and fields[2].strip() == 'transcode2H265':
+                timings.append(int(fields[1])/1e6)
+
+    timings.sort()
+    return timings[0],timings[len(timings)//2],int(result.stdout)
+
+def time_command(cmd,repetitions):
+    timings=[]
+    for repetition in range(repetitions):
+        start_time=time.perf_counter()
+        subprocess.run(cmd,stdout=subprocess.DEVNULL,stderr=subprocess.DEVNULL)
+        timings.append(time.perf_counter()-start_time)
+
+    timings.sort()
+    return timings[0],timings[len(timings)//2]
+
+def main():
+    repetitions=int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    maximum=float(sys.argv[2])/1000 if len(sys.argv) > 2 else None
+    too_slow=[]
+    for name,cmd in cases:
+        best,median=time_command(cmd,repetitions)
+        print('{:16} best {:6.1f} ms, median {:6.1f} ms over {:d} runs'.format(name,best*1000,median*1000,repetitions))
+        if maximum and name != 'python only' and median > maximum:
+            too_slow.append(name)
+
+    best,median,modules=time_import(repetitions)
+    print('{:16} best {:6.1f} ms, median {:6.1f} ms over {:d} runs, {:d} modules loaded'.format('import itself',best*1000,median*1000,repetitions,modules))
+    if too_slow:
+        print('Slower than {:.0f} ms: {}'.format(maximum*1000,', '.join(too_slow)))
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+## Tests of the ASS/SSA to SRT conversion of transcode2H265.py.
+##
+## Usage: python3 -m unittest discover tests
+##
+
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import transcode2H265
+
+class Ass2SrtTest(unittest.TestCase):
+    def convert(self,ass_text):
+        with tempfile.TemporaryDirectory() as directory:
+            ass_filename=os.path.join(directory,'test.ass')
+            srt_filename=os.path.join(directory,'test.srt')
+            with open(ass_filename,'w',encoding='utf-8') as ass_file:
+                ass_file.write(ass_text)
+
+            if transcode2H265.ass2srt(ass_filename,srt_filename) is None:
+                return None
+
+            with open(srt_filename,encoding='utf-8') as srt_file:
+                return srt_file.read()
+
+    def test_dialogue_lines(self):
+        srt=self.convert('[Events]\n'
+                         'Format: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text\n'
+                         'Dialogue: 0,0:00:01.00,0:00:02.50,Default,,0,0,0,,{\\i1}Hello{\\i0}, world\\Nsecond line\n'
+                         'Dialogue: 0,0:00:03.00,0:00:04.00,Default,,0,0,0,,{\\p1}m 0 0 l 100 0 100 100{\\p0}\n')
+        self.assertEqual(srt,'1\n00:00:01,000 --> 00:00:02,500\nHello, world\nsecond line\n\n')
+
+    def test_without_format_line(self):
+        srt=self.convert('[Events]\nDialogue: 0,0:00:01.00,0:00:02.00,Default,,0,0,0,,Text\n')
+        self.assertEqual(srt,'1\n00:00:01,000 --> 00:00:02,000\nText\n\n')
+
+    def test_without_events(self):
+        self.assertIsNone(self.convert('[Script Info]\nScriptType: v4.00+\n'))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+## Tests of the persistent cache of transcode2H265.py.
+##
+## Usage: python3 -m unittest discover tests
+##
+
+import os
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import transcode2H265
+
+class CacheTest(unittest.TestCase):
+    def setUp(self):
+        self.directory=tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def create_file(self,name,data='data'):
+        filename=os.path.join(self.directory.name,name)
+        with open(filename,'w') as created_file:
+            created_file.write(data)
+
+        return filename
+
+    def open_cache(self,**limits):
+        cache=transcode2H265.Cache(os.path.join(self.directory.name,'cache','cache.db'),**limits)
+        self.addCleanup(cache.close)
+        return cache
+
+    def test_invalidation(self):
+        cache=self.open_cache()
+        video=self.create_file('video.mkv')
+        cache.set(video,'probe',{'streams': []})
+        cache.set(video,'crop','100:100:0:0')
+        self.assertEqual(cache.get(video,'probe'),{'streams': []})
+        self.assertIsNone(cache.get(video,'outcome'))
+        self.create_file('video.mkv','other data')
+        self.assertIsNone(cache.get(video,'probe'))
+        cache.set(video,'probe',{'streams': [{}]})
+        os.utime(video,ns=(0,0)) # Back to any previous time, it must not match either.
+        self.assertIsNone(cache.get(video,'crop'))
+        self.assertIsNone(cache.get(os.path.join(self.directory.name,'missing.mkv'),'probe'))
+
+    def test_persistence(self):
+        video=self.create_file('video.mkv')
+        cache=self.open_cache()
+        cache.set(video,'probe',[1,2])
+        cache.close()
+        self.assertEqual(self.open_cache().get(video,'probe'),[1,2])
+
+    def test_max_files(self):
+        cache=self.open_cache(max_files=2)
+        videos=[self.create_file('video{:d}.mkv'.format(n)) for n in range(3)]
+        cache.set(videos[0],'probe',0)
+        cache.set(videos[1],'probe',1)
+        time.sleep(0.01)
+        cache.get(videos[0],'probe') # Used more recently than the second one.
+        cache.set(videos[2],'probe',2)
+        self.assertEqual(cache.get(videos[0],'probe'),0)
+        self.assertIsNone(cache.get(videos[1],'probe'))
+        self.assertEqual(cache.get(videos[2],'probe'),2)
+
+    def test_max_data_size(self):
+        cache=self.open_cache(max_data_size=1500)
+        videos=[self.create_file('video{:d}.mkv'.format(n)) for n in range(3)]
+        data_filenames=[cache.get_data_filename(video,'first pass') for video in videos]
+        for n,data_filename in enumerate(data_filenames[:2]):
+            for extension in ('.log','.dat'):
+                with open(data_filename+extension,'w') as data_file:
+                    data_file.write('x'*400)
+
+                os.utime(data_filename+extension,(n,n)) # The older ones are evicted first.
+
+        self.assertEqual(cache.get_data_filename(videos[0],'first pass'),data_filenames[0])
+        self.assertTrue(os.path.isfile(data_filenames[0]+'.dat')) # Kept, as it is being used, although it is the oldest.
+        self.assertFalse(os.path.isfile(data_filenames[1]+'.log'))
+        self.assertFalse(os.path.isfile(data_filenames[1]+'.dat'))
+        cache.get_data_filename(videos[2],'first pass')
+        self.assertTrue(os.path.isfile(data_filenames[0]+'.dat')) # Under the maximum size.
+        self.assertNotEqual(cache.get_data_filename(videos[0],'other'),data_filenames[0])
+
+if __name__ == "__main__":
+    unittest.main()
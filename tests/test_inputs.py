@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+## Tests of the handling of the input arguments of transcode2H265.py: sizes and directories.
+##
+## Usage: python3 -m unittest discover tests
+##
+
+import argparse
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import transcode2H265
+
+class ParseSizeTest(unittest.TestCase):
+    def test_units(self):
+        self.assertEqual(transcode2H265.parse_size('700'),700*2**20)
+        self.assertEqual(transcode2H265.parse_size('700M'),700*2**20)
+        self.assertEqual(transcode2H265.parse_size('4.5G'),int(4.5*2**30))
+        self.assertEqual(transcode2H265.parse_size('800000k'),800000*2**10)
+        self.assertEqual(transcode2H265.parse_size(' 1TiB '),2**40)
+        self.assertEqual(transcode2H265.parse_size('.5GB'),2**29)
+
+    def test_invalid(self):
+        for text in ('','0','M','-1G','1X','1,5G'):
+            with self.assertRaises(argparse.ArgumentTypeError,msg=text):
+                transcode2H265.parse_size(text)
+
+class FindVideoFilesTest(unittest.TestCase):
+    def setUp(self):
+        self.directory=tempfile.TemporaryDirectory()
+        self.root=self.directory.name
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def create_file(self,name,size=100):
+        filename=os.path.join(self.root,name)
+        os.makedirs(os.path.dirname(filename),exist_ok=True)
+        with open(filename,'wb') as created_file:
+            created_file.write(b'x'*size)
+
+        return filename
+
+    def find(self,paths,min_size=10):
+        with contextlib.redirect_stdout(io.StringIO()):
+            return transcode2H265.find_video_files(paths,{'.mkv','.mp4'},min_size,'_h265')
+
+    def test_directories(self):
+        videos=[self.create_file('a.mkv'),self.create_file('b/c.MP4'),self.create_file('b/d/e.mkv')]
+        for name in ('notes.nfo','small.mkv','.hidden.mkv','a_h265.mkv','a_tmp_x1_output.mkv','b/.f.mp4'):
+            self.create_file(name,1 if name == 'small.mkv' else 100)
+
+        self.assertEqual(sorted(self.find([self.root])),videos)
+
+    def test_files_given(self):
+        given=[self.create_file('notes.nfo',1),os.path.join(self.root,'missing.mkv')]
+        self.assertEqual(self.find(given),given) # They are checked, and reported, later.
+
+    def test_duplicates(self):
+        video=self.create_file('b/a.mkv')
+        os.link(video,os.path.join(self.root,'b','hard.mkv'))
+        os.symlink(os.path.join(self.root,'b'),os.path.join(self.root,'link'))
+        self.assertEqual(self.find([self.root,video,os.path.join(self.root,'b')]),[video])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+## Tests of the batch journal of transcode2H265.py, used by --resume.
+##
+## Usage: python3 -m unittest discover tests
+##
+
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import transcode2H265
+
+class JournalTest(unittest.TestCase):
+    def setUp(self):
+        self.directory=tempfile.TemporaryDirectory()
+        self.filename=os.path.join(self.directory.name,'journal.jsonl')
+        self.videos=[os.path.join(self.directory.name,name) for name in ('a.mkv','b.mkv','c.mkv')]
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def create_file(self,filename):
+        with open(filename,'w') as created_file:
+            created_file.write('data')
+
+    def test_resume(self):
+        journal=transcode2H265.Journal(self.filename)
+        journal.start(self.videos)
+        journal.record(self.videos[0],'done',output=self.videos[0]+'.out')
+        journal.record(self.videos[1],'encoding',tmp_root=self.videos[1]+'_tmp_x')
+        with open(self.filename,'a') as journal_file:
+            journal_file.write('{"file": "cut by the cr') # The last write of a crash.
+
+        resumed=transcode2H265.Journal(self.filename)
+        self.assertTrue(resumed.load())
+        self.assertEqual(resumed.get_files(),self.videos)
+        self.assertTrue(resumed.is_done(self.videos[0]))
+        self.assertFalse(resumed.is_done(self.videos[1]))
+        self.assertFalse(resumed.is_done(self.videos[2]))
+
+    def test_without_journal(self):
+        self.assertFalse(transcode2H265.Journal(self.filename).load())
+
+    def test_clean_orphans(self):
+        journal=transcode2H265.Journal(self.filename)
+        journal.start(self.videos)
+        journal.record(self.videos[0],'encoding',tmp_root=self.videos[0]+'_tmp_one')
+        journal.record(self.videos[0],'muxing',tmp_root=self.videos[0]+'_tmp_two')
+        journal.record(self.videos[1],'encoding',tmp_root=self.videos[1]+'_tmp_three')
+        journal.record(self.videos[1],'done',output=self.videos[1]+'.out')
+        orphans=[self.videos[0]+'_tmp_one_output.mkv',self.videos[0]+'_tmp_one.log',self.videos[0]+'_tmp_two_output.mkv']
+        kept=[self.videos[0],self.videos[0]+'_tmp_other.mkv',self.videos[1]+'_tmp_three_output.mkv',self.videos[1]+'.out']
+        for filename in orphans+kept:
+            self.create_file(filename)
+
+        resumed=transcode2H265.Journal(self.filename)
+        resumed.load()
+        with contextlib.redirect_stdout(io.StringIO()):
+            resumed.clean_orphans()
+
+        for filename in orphans:
+            self.assertFalse(os.path.exists(filename),filename)
+
+        for filename in kept:
+            self.assertTrue(os.path.exists(filename),filename) # Other batches and finished files are left alone.
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,34 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+## Tests of the parsing of the ffprobe JSON output of transcode2H265.py.
+##
+## Usage: python3 -m unittest discover tests
+##
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import transcode2H265
+
+class MediaInfoTest(unittest.TestCase):
+    def test_cover_before_the_video(self):
+        media_info=transcode2H265.MediaInfo({'streams': [{'index': 0, 'codec_type': 'video', 'codec_name': 'mjpeg', 'disposition': {'attached_pic': 1}},
+                                                          {'index': 1, 'codec_type': 'video', 'codec_name': 'h264', 'width': 1920, 'height': 1080, 'avg_frame_rate': '24000/1001'},
+                                                          {'index': 2, 'codec_type': 'audio', 'codec_name': 'aac', 'channels': 2, 'tags': {'language': 'eng'}}],
+                                              'format': {'duration': '60.5', 'size': '1000'}})
+        self.assertEqual(media_info.get_video_index(),1)
+        self.assertEqual(media_info.get_video_codec(),'h264')
+        self.assertEqual(media_info.get_dimensions(),(1920,1080))
+        self.assertEqual([stream.index for stream in media_info.get_audio_streams()],[2])
+        self.assertEqual(media_info.get_duration(),60.5)
+
+    def test_text_file(self):
+        media_info=transcode2H265.MediaInfo({'streams': [{'index': 0, 'codec_type': 'video', 'codec_name': 'ansi'}]})
+        self.assertFalse(media_info.has_video())
+        self.assertIsNone(media_info.get_video_index())
+
+if __name__ == "__main__":
+    unittest.main()
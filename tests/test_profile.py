@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+## Tests of the --profile option of transcode2H265.py, transcoding a short synthetic video.
+##
+## Usage: python3 -m unittest discover tests
+##
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+script=os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','transcode2H265.py')
+
+@unittest.skipUnless(all(shutil.which(program) for program in ('ffmpeg','ffprobe','mkvmerge','mkvextract')),'ffmpeg and mkvtoolnix are needed')
+class ProfileTest(unittest.TestCase):
+    def run_script(self,*args):
+        with tempfile.TemporaryDirectory() as directory:
+            video=os.path.join(directory,'video.mp4')
+            subprocess.run(['ffmpeg','-v','error','-f','lavfi','-i','testsrc2=duration=2:size=160x120:rate=24','-c:v','libx264','-b:v','2M',video],check=True)
+            profile=os.path.join(directory,'profile.txt')
+            result=subprocess.run([sys.executable,script,'--no-cache','-p','ultrafast','--max-size-ratio','0','--journal',os.path.join(directory,'journal.jsonl'),'--profile',profile]+list(args)+[video],
+                                  stdout=subprocess.PIPE,stderr=subprocess.STDOUT,universal_newlines=True,env=dict(os.environ,XDG_CACHE_HOME=directory))
+            with open(profile) as profile_file:
+                statistics=profile_file.read()
+
+            return result,statistics,os.path.isfile(os.path.join(directory,'video_h265.mkv'))
+
+    def check(self,*args):
+        result,statistics,transcoded=self.run_script(*args)
+        self.assertEqual(result.returncode,0,result.stdout)
+        self.assertTrue(transcoded,result.stdout)
+        self.assertNotIn('Traceback',result.stdout)
+        self.assertIn('function calls',statistics)
+        self.assertIn('transcode_video',statistics) # The job is in the profile.
+
+    def test_one_job(self):
+        self.check('-j','1')
+
+    def test_several_jobs(self):
+        self.check('-j','2')
+
+if __name__ == "__main__":
+    unittest.main()
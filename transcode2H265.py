@@ -20,17 +20,34 @@
 import sys
 import os
 import time
-import random
 import subprocess
 import gettext
-import string
+import shlex
+import json
+import re
+import collections
+import resource
+import atexit
+import shutil
+import errno
+import signal
+import select
+import threading
+## Slow to import modules only needed by some options (sqlite3, csv, http.server, cProfile, socketserver...) or by a few functions (random...) are imported where they are used, to start faster.
 
 ## Setting internationalization
 localedir = os.path.join(os.path.abspath(os.path.dirname(os.path.realpath(__file__))), 'locale')
 
-translate = gettext.translation('transcode2H265', localedir, fallback=True)
+translate = None
 
-_ = translate.gettext
+def _(text):
+    """Returns the translation of text, loading the catalog the first time it is needed.
+    """
+    global translate
+    if translate is None:
+        translate = gettext.translation('transcode2H265', localedir, fallback=True)
+
+    return translate.gettext(text)
 
 def i18n_text_argparse(text):
     text = text.replace("usage", _("usage"))
@@ -56,12 +73,458 @@ import argparse ## Need to be imported after the previous declarations, to allow
 
 
 ## Classes
+AudioStream=collections.namedtuple('AudioStream', ['index', 'codec', 'language', 'channels', 'bit_rate'])
+SubtitleStream=collections.namedtuple('SubtitleStream', ['index', 'codec', 'language'])
+
+class MediaInfo:
+    """Compact stream metadata of a media file, built from the JSON output of ffprobe.
+    
+    """
+    def __init__(self,probe_data):
+        self.__video_index=None
+        self.__video_codec=None
+        self.__width=None
+        self.__height=None
+        self.__frame_rate=None
+        self.__video_bit_rate=None
+        self.__audio_streams=[]
+        self.__subtitle_streams=[]
+        self.__duration=None
+        self.__bit_rate=None
+        self.__size=None
+        self.__parse(probe_data)
+
+    def __parse(self,probe_data):
+        for stream in probe_data.get('streams',[]):
+            codec_type=stream.get('codec_type')
+            codec=stream.get('codec_name')
+            language=normalize_language(stream.get('tags',{}).get('language'))
+            if codec_type == 'video':
+                # Text files are detected as 'ansi' video, and cover images as attached pictures.
+                if self.__video_codec or codec in (None,'ansi') or stream.get('disposition',{}).get('attached_pic'):
+                    continue
+
+                self.__video_index=stream['index']
+                self.__video_codec=codec
+                self.__width=stream.get('width')
+                self.__height=stream.get('height')
+                self.__frame_rate=parse_rate(stream.get('avg_frame_rate')) or parse_rate(stream.get('r_frame_rate'))
+                self.__video_bit_rate=parse_number(stream.get('bit_rate'),int)
+
+            elif codec_type == 'audio':
+                bit_rate=stream.get('bit_rate') or stream.get('tags',{}).get('BPS') # Matroska only has it in the statistics tags of mkvmerge.
+                self.__audio_streams.append(AudioStream(stream['index'], codec, language, stream.get('channels'), parse_number(bit_rate,int)))
+
+            elif codec_type == 'subtitle':
+                self.__subtitle_streams.append(SubtitleStream(stream['index'], codec, language))
+
+        media_format=probe_data.get('format',{})
+        self.__duration=parse_number(media_format.get('duration'),float)
+        self.__bit_rate=parse_number(media_format.get('bit_rate'),int)
+        self.__size=parse_number(media_format.get('size'),int)
+
+    def has_video(self):
+        return self.__video_codec is not None
+
+    def get_video_index(self):
+        """Returns the index of the video stream to transcode, that is not always the first one (cover images are video streams too).
+        
+        """
+        return self.__video_index
+
+    def get_video_codec(self):
+        return self.__video_codec
+
+    def get_dimensions(self):
+        return self.__width,self.__height
+
+    def get_frame_rate(self):
+        return self.__frame_rate
+
+    def get_video_bit_rate(self):
+        """Returns the bit rate of the video stream, or the overall bit rate if it is not known.
+        
+        """
+        return self.__video_bit_rate or self.__bit_rate
+
+    def get_audio_streams(self):
+        return self.__audio_streams
+
+    def get_subtitle_streams(self):
+        return self.__subtitle_streams
+
+    def get_duration(self):
+        return self.__duration
+
+    def get_size(self):
+        return self.__size
+
+class Cache:
+    """Persistent store of probe results, crop rectangles and transcoding outcomes.
+
+    Entries are keyed by the real path of the input file and are only valid while its size
+    and modification time are unchanged. The least recently used files are evicted when the
+    cache holds more than max_files of them, and the least recently used bulky data files
+    (see get_data_filename) when they take more than max_data_size bytes.
+    """
+    def __init__(self,filename,max_files=10000,max_data_size=10*2**30):
+        self.__max_files=max_files
+        self.__max_data_size=max_data_size
+        self.__lock=threading.Lock() # The connection is shared by all transcoding jobs.
+        self.__directory=os.path.dirname(filename)
+        os.makedirs(self.__directory,exist_ok=True)
+        import sqlite3
+        self.__connection=sqlite3.connect(filename,timeout=30,check_same_thread=False,isolation_level=None)
+        self.__connection.execute('CREATE TABLE IF NOT EXISTS entries (path TEXT, size INTEGER, mtime_ns INTEGER, kind TEXT, data TEXT, accessed REAL, PRIMARY KEY (path, kind))')
+        self.__connection.execute('CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)')
+
+    def __identity(self,filename):
+        try:
+            stat=os.stat(filename)
+
+        except OSError:
+            return None
+
+        return os.path.realpath(filename),stat.st_size,stat.st_mtime_ns
+
+    def get(self,filename,kind):
+        """Returns the stored data of the given kind for filename, or None if missing or stale.
+        
+        """
+        identity=self.__identity(filename)
+        if not identity:
+            return None
+
+        path,size,mtime_ns=identity
+        with self.__lock:
+            row=self.__connection.execute('SELECT data FROM entries WHERE path=? AND kind=? AND size=? AND mtime_ns=?',(path,kind,size,mtime_ns)).fetchone()
+            if not row:
+                return None
+
+            self.__connection.execute('UPDATE entries SET accessed=? WHERE path=?',(time.time(),path))
+
+        return json.loads(row[0])
+
+    def set(self,filename,kind,data):
+        identity=self.__identity(filename)
+        if not identity:
+            return
+
+        path,size,mtime_ns=identity
+        with self.__lock:
+            self.__connection.execute('DELETE FROM entries WHERE path=? AND (size!=? OR mtime_ns!=?)',(path,size,mtime_ns)) # Everything known about an older version of the file.
+            self.__connection.execute('INSERT OR REPLACE INTO entries VALUES (?,?,?,?,?,?)',(path,size,mtime_ns,kind,json.dumps(data,separators=(',',':')),time.time()))
+            self.__evict()
+
+    def __evict(self):
+        files=self.__connection.execute('SELECT COUNT(DISTINCT path) FROM entries').fetchone()[0]
+        if files > self.__max_files:
+            self.__connection.execute('DELETE FROM entries WHERE path IN (SELECT path FROM entries GROUP BY path ORDER BY MAX(accessed) LIMIT ?)',(files-self.__max_files,))
+
+    def get_data_filename(self,filename,name):
+        """Returns a path in the cache directory to keep bulky data about filename, that is not valid once the file changes.
+        
+        """
+        identity=self.__identity(filename)
+        if not identity:
+            return None
+
+        directory=os.path.join(self.__directory,'data')
+        os.makedirs(directory,exist_ok=True)
+        import hashlib
+        data_filename=os.path.join(directory,hashlib.sha1(json.dumps(list(identity)+[name]).encode('utf-8')).hexdigest())
+        self.__evict_data(directory,os.path.basename(data_filename))
+        return data_filename
+
+    def __evict_data(self,directory,keep):
+        """Removes the least recently used data files, all the files of each name at once, while they take more than the maximum size.
+        
+        """
+        groups={} # name (without extensions): [size, last use, files]
+        for entry in os.scandir(directory):
+            try:
+                stat=entry.stat()
+
+            except OSError:
+                continue
+
+            group=groups.setdefault(entry.name.split('.')[0],[0,0,[]])
+            group[0]+=stat.st_size
+            group[1]=max(group[1],stat.st_atime,stat.st_mtime)
+            group[2].append(entry.path)
+
+        total_size=sum(group[0] for group in groups.values())
+        for name,(size,last_use,files) in sorted(groups.items(),key=lambda item: item[1][1]):
+            if total_size <= self.__max_data_size:
+                break
+
+            if name == keep:
+                continue
+
+            for data_file in files:
+                try:
+                    os.remove(data_file)
+
+                except OSError:
+                    pass
+
+            total_size-=size
+
+    def close(self):
+        with self.__lock:
+            self.__connection.close()
+
+class ProcessRunner:
+    """Runs the external programs, so they can all be limited, watched and stopped from a single place.
+
+    Every process runs in its own session (so its own process group), with the configured nice and
+    ionice priorities and CPU affinity. A process is killed, together with any children it may have,
+    if it runs longer than its timeout, or if it stalls: no output and no bytes read or written for
+    stall_timeout seconds. On SIGINT or SIGTERM all the running processes are killed, and the
+    registered temporary files are removed when the script exits, whatever the reason.
+    """
+    def __init__(self):
+        self.__nice=0
+        self.__ionice=None # (class, level) tuple.
+        self.__cpu_affinity=None # Set of CPU numbers.
+        self.__stall_timeout=None
+        self.__probe_timeout=120
+        self.__processes=set()
+        self.__tmp_roots=set() # Prefixes of the temporary files of the videos being processed.
+        self.__cancelled=False
+        self.__signal_number=None
+        self.__programs={} # Full path of each program, found once.
+        self.__lock=threading.Lock()
+        atexit.register(self.remove_temporary_files)
+
+    def configure(self,nice=0,ionice=None,cpu_affinity=None,stall_timeout=None,probe_timeout=120):
+        self.__nice=nice
+        self.__ionice=ionice
+        self.__cpu_affinity=cpu_affinity
+        self.__stall_timeout=stall_timeout
+        self.__probe_timeout=probe_timeout
+
+    def set_programs(self,programs):
+        """Makes the programs named as keys of programs be run from the path given as their value, instead of being searched in the PATH every time.
+        
+        """
+        self.__programs=dict(programs)
+
+    def get_probe_timeout(self):
+        """Returns the seconds a quick probe of a file (ffprobe, a few frames decoded...) may take.
+        
+        """
+        return self.__probe_timeout
+
+    def __command_prefix(self):
+        prefix=[]
+        if self.__nice:
+            prefix+=['nice', '-n', str(self.__nice)]
+
+        if self.__ionice and shutil.which('ionice'):
+            prefix+=['ionice', '-c', str(self.__ionice[0])]
+            if self.__ionice[1] is not None:
+                prefix+=['-n', str(self.__ionice[1])]
+
+        if self.__cpu_affinity and shutil.which('taskset'):
+            prefix+=['taskset', '-c', ','.join(str(cpu) for cpu in sorted(self.__cpu_affinity))] # Set before the program starts any thread.
+
+        return prefix
+
+    def run(self,cmd,timeout=None,stdout=None,stderr=None,line_callback=None):
+        """Runs cmd (an argument list) and returns a subprocess.CompletedProcess.
+
+        stdout and stderr may be None (inherited), subprocess.DEVNULL or subprocess.PIPE (captured as
+        text). If line_callback is given, it is called with every line of the standard output instead.
+        A killed process has a negative return code.
+        """
+        if self.__cancelled:
+            return subprocess.CompletedProcess(cmd,-signal.SIGTERM,'','')
+
+        if line_callback:
+            stdout=subprocess.PIPE
+
+        try:
+            process=subprocess.Popen(self.__command_prefix()+[self.__programs.get(cmd[0],cmd[0])]+cmd[1:], stdout=stdout, stderr=stderr, stdin=subprocess.DEVNULL, universal_newlines=True, errors='replace', start_new_session=True)
+
+        except OSError as error:
+            sys.stderr.write(_("ERROR: {} could not be run: {}\n").format(cmd[0],error))
+            return subprocess.CompletedProcess(cmd,127,'','')
+
+        with self.__lock:
+            self.__processes.add(process)
+
+        activity=[time.time()]
+        outputs={}
+        readers=[]
+        for name,stream in (('stdout',process.stdout),('stderr',process.stderr)):
+            if stream:
+                outputs[name]=[]
+                readers.append(threading.Thread(target=self.__read_stream,args=(stream,outputs[name],line_callback if name == 'stdout' else None,activity),daemon=True))
+                readers[-1].start()
+
+        try:
+            reason=self.__watch(process,timeout,activity,line_callback is not None)
+
+        finally:
+            with self.__lock:
+                self.__processes.discard(process)
+
+        for reader in readers:
+            reader.join()
+
+        if reason:
+            sys.stderr.write(_("ERROR: {} was stopped, {}.\n").format(cmd[0],reason))
+
+        return subprocess.CompletedProcess(cmd,process.returncode,''.join(outputs.get('stdout',[])),''.join(outputs.get('stderr',[])))
+
+    def __read_stream(self,stream,lines,line_callback,activity):
+        for line in stream:
+            activity[0]=time.time()
+            if line_callback:
+                line_callback(line)
+
+            else:
+                lines.append(line)
+
+        stream.close()
+
+    def __watch(self,process,timeout,activity,reports_progress=False):
+        """Waits for process to finish, killing it if it runs out of time or stalls. Returns why it was killed, or None.
+
+        Where the disk reads and writes of the process can not be known, only a process that reports its
+        progress (to a line_callback) is considered stalled, when it stops reporting it.
+        """
+        start_time=time.time()
+        io_counters=None
+        stall_timeout=self.__stall_timeout
+        while True:
+            try:
+                process.wait(timeout=1)
+                return None
+
+            except subprocess.TimeoutExpired:
+                pass
+
+            now=time.time()
+            if timeout and now-start_time > timeout:
+                self.__kill(process)
+                return _('it took more than {:d} seconds').format(int(timeout))
+
+            if stall_timeout:
+                new_io_counters=read_io_counters(process.pid,None)
+                if new_io_counters is None and not reports_progress:
+                    stall_timeout=None # Its silence does not mean it is stalled.
+                    continue
+
+                if new_io_counters != io_counters:
+                    io_counters=new_io_counters
+                    activity[0]=max(activity[0],now)
+
+                if now-activity[0] > stall_timeout:
+                    self.__kill(process)
+                    return _('it made no progress in {:d} seconds').format(int(stall_timeout))
+
+    def __kill(self,process):
+        """Terminates the process group of process, killing it if it does not end in a few seconds.
+        
+        """
+        for signal_number in (signal.SIGTERM,signal.SIGKILL):
+            try:
+                os.killpg(process.pid,signal_number)
+
+            except OSError:
+                return # Already gone.
+
+            try:
+                process.wait(timeout=5)
+                return
+
+            except subprocess.TimeoutExpired:
+                pass
+
+    def handle_signal(self,signal_number,frame):
+        """Kills all the running processes, and stops as with Ctrl+C.
+        
+        """
+        self.__cancelled=True # No new process is started from now on.
+        self.__signal_number=signal_number
+        processes=self.__processes.copy() # Without the lock, that this same thread may be holding when interrupted.
+
+        for process in processes:
+            try:
+                os.killpg(process.pid,signal.SIGKILL)
+
+            except OSError:
+                pass
+
+        raise KeyboardInterrupt()
+
+    def get_exit_status(self):
+        """Returns the exit status of a process killed by the signal received (130 for SIGINT, 143 for SIGTERM), or 0 if there was none.
+        
+        """
+        return 128+self.__signal_number if self.__signal_number else 0
+
+    def add_temporary_root(self,tmp_root):
+        with self.__lock:
+            self.__tmp_roots.add(tmp_root)
+
+    def discard_temporary_root(self,tmp_root):
+        with self.__lock:
+            self.__tmp_roots.discard(tmp_root)
+
+    def remove_temporary_files(self):
+        """Removes every file starting with a registered temporary root.
+        
+        """
+        with self.__lock:
+            tmp_roots=set(self.__tmp_roots)
+            self.__tmp_roots.clear()
+
+        tmp_files=set()
+        for tmp_root in tmp_roots:
+            tmp_dir=os.path.dirname(tmp_root) or '.'
+            if os.path.isdir(tmp_dir):
+                tmp_files.update(os.path.join(tmp_dir,name) for name in os.listdir(tmp_dir) if name.startswith(os.path.basename(tmp_root)))
+
+        for tmp_file in tmp_files:
+            if os.path.isfile(tmp_file):
+                print(_("Removing temporary file '{}'.").format(tmp_file))
+                os.remove(tmp_file)
+
+process_runner=ProcessRunner()
+
+class StageTimer:
+    """Measures a stage of the processing of a file, adding its figures to the stages dictionary.
+
+    Wall time, processor time of the finished child processes (from getrusage) and bytes read and
+    written (from /proc/self/io, which includes the finished children) are measured. The last two are
+    of the whole script, so with several jobs at the same time they include the work of the others.
+    """
+    def __init__(self,stages,name):
+        self.__stages=stages
+        self.__name=name
+
+    def __enter__(self):
+        self.__start=(time.time(),children_cpu_time())+read_io_counters()
+        return self
+
+    def __exit__(self,exc_type,exc_value,traceback):
+        end=(time.time(),children_cpu_time())+read_io_counters()
+        stage=self.__stages.setdefault(self.__name,{'wall': 0, 'cpu': 0, 'read': 0, 'written': 0})
+        for key,start_value,end_value in zip(('wall','cpu','read','written'),self.__start,end):
+            stage[key]+=end_value-start_value
+
+        return False
+
 class Video:
     """Contains actual and proposed video information, and can transforme itself.
     
     """
-    def __init__(self,filename):
+    def __init__(self,filename,cache=None):
         self.__in_filename=filename       
+        self.__cache=cache # A Cache object, or None to always probe the file.
         self.__in_ok=False
         self.__in_duration=None
         self.__avlang = None
@@ -71,43 +534,146 @@ class Video:
         self.__int_sub_files=[] # Now a list, for more than one sub files. This files are removed after the script is completed.
         self.__sub_charsets={} # Now a dictionary, with each subfile as a key.
         self.__sub_exts=['.srt','.ass','.ssa','.txt']        
+        self.__int_sub_exts={'subrip':'.srt','ass':'.ass','ssa':'.ass','hdmv_pgs_subtitle':'.sup'} # Extensions of extracted subtitles, by codec.
+        self.__ffmpeg_sub_codecs={'subrip':'copy','ass':'copy','ssa':'copy','webvtt':'copy','hdmv_pgs_subtitle':'copy','dvd_subtitle':'copy','dvb_subtitle':'copy','mov_text':'srt','text':'srt'} # How ffmpeg puts each subtitle codec into MKV.
+        self.__ffmpeg_sub_exts=['.srt','.ass','.ssa'] # External subtitles ffmpeg can put into MKV.
         self.__default_avlang='eng'
         self.__default_slang='spa'        
         self.__slangs = {} # To support multiple subtitles.
         self.__ffmpeg_output_ext='.mkv'
         self.__ffmpeg_output_postfix='_tmp_' + random_string(10)
-        self.__ffmpeg_output=os.path.splitext(self.__in_filename)[0]+self.__ffmpeg_output_postfix+self.__ffmpeg_output_ext
+        self.__local_tmp_root=os.path.splitext(self.__in_filename)[0]+self.__ffmpeg_output_postfix # Next to the input.
+        self.__tmp_root=self.__local_tmp_root # All temporary files start with this, in the scratch directory if there is one.
+        self.__ffmpeg_output=self.__tmp_root+self.__ffmpeg_output_ext
+        self.__work_output=self.__tmp_root+'_output'+self.__ffmpeg_output_ext # The final file, until it is complete and moved into place.
         self.__replace_original=False
         self.__output_postfix=None
         self.__threads=None
         self.__crop_data=None
-        self.__get_input_data()
+        self.__crop_samples=5
+        self.__crop_spread=0.9
+        self.__crop_seed=None
+        self.__quiet=False
+        self.__chunks=1
+        self.__mux='ffmpeg'
+        self.__direct_mux=False
+        self.__to_srt=False
+        self.__audio_codec='aac'
+        self.__audio_bitrate=96 # kb/s per channel.
+        self.__audio_encoders={'aac':'aac','opus':'libopus'}
+        self.__separate_audio=False
+        self.__target_size=None # Bytes.
+        self.__target_bitrate=None # kb/s.
+        self.__video_bit_rate=None
+        self.__two_pass_root=None
+        self.__two_pass_dir=None # Temporary directory of the two pass files, when they are not kept in the cache.
+        self.__scratch_dir=None
+        self.__two_pass_stage=None
+        self.__two_pass_attempts=3
+        self.__analysis_reuse_level=5 # Highest level valid for a second pass with another bit rate.
+        self.__telemetry=None
+        self.__progress=None
+        self.__journal=None
+        self.__media_info=None
+        self.__output_filename=None
+        self.__max_size_ratio=None
+        self.__skip_reason=None
+        self.__stages={} # Figures of each processing stage, see StageTimer.
+        self.__output_check=None
+        with StageTimer(self.__stages,'probe'):
+            self.__get_input_data()
 
     def __get_input_data(self):
         if os.path.isfile(self.__in_filename):
-            cproc = subprocess.run(["ffmpeg", "-i", self.__in_filename], stdout = subprocess.DEVNULL, stderr = subprocess.PIPE, universal_newlines = True)
-            for line in cproc.stderr.split('\n'):
-                line=line.strip()
-                if ('Video' in line) and ('Stream' in line):
-                    if 'ansi' not in line:
-                        self.__in_ok=True
-                    
-                if ('Audio' in line) and ('Stream' in line):
-                    if '(' in line.split(':')[1]:
-                        self.__avlang = line.split(':')[1].split('(')[1].strip(')')
-                        if "unk" in self.__avlang.lower() or "und" in self.__avlang.lower():
-                            self.__avlang = None
-                    
-                if 'Duration' in line:
-                    duration_string=line.split(',')[0].split()[1]
-                    if not 'N/A' in duration_string:
-                        self.__in_duration=dstring2dint(duration_string)
+            probe_data=None
+            if self.__cache:
+                probe_data=self.__cache.get(self.__in_filename,'probe')
+
+            if probe_data is None:
+                probe_data=run_ffprobe(self.__in_filename)
+                if probe_data is not None and self.__cache:
+                    self.__cache.set(self.__in_filename,'probe',probe_data)
+
+            if probe_data is not None:
+                self.__media_info=MediaInfo(probe_data)
+                self.__in_ok=self.__media_info.has_video()
+                self.__in_duration=self.__media_info.get_duration()
+                audio_streams=self.__media_info.get_audio_streams()
+                if audio_streams:
+                    self.__avlang=audio_streams[0].language
 
     def is_ok(self):
         """Returns true is video file exist and it is actually a video.
         
         """
         return self.__in_ok
+
+    def get_filename(self):
+        return self.__in_filename
+
+    def get_duration(self):
+        """Returns the input duration in seconds, or 0 if it could not be determined.
+
+        """
+        return self.__in_duration or 0
+
+    def get_output_filename(self):
+        return self.__output_filename
+
+    def get_report(self):
+        """Returns the sizes, compression ratio and stage figures of the file, ready to be dumped as JSON.
+        
+        """
+        in_size=os.path.getsize(self.__in_filename) if os.path.isfile(self.__in_filename) else None
+        out_size=os.path.getsize(self.__output_filename) if self.__output_filename and os.path.isfile(self.__output_filename) else None
+        return {
+            'file': self.__in_filename,
+            'output': self.__output_filename,
+            'duration': self.__in_duration,
+            'input_size': in_size or (self.__media_info.get_size() if self.__media_info else None), # The original may be gone with -r.
+            'output_size': out_size,
+            'ratio': round(out_size/in_size,4) if in_size and out_size else None,
+            'stages': {name: {key: round(value,3) for key,value in stage.items()} for name,stage in self.__stages.items()},
+        }
+
+    def get_skip_reason(self):
+        """Returns why the output was discarded after transcoding, or None.
+        
+        """
+        return self.__skip_reason
+
+    def check_skip_rules(self,postfix,min_bpp=0):
+        """Returns the reason why this video is not worth transcoding, or None if it should be transcoded.
+        
+        """
+        if self.__media_info.get_video_codec() == 'hevc':
+            return _('already HEVC')
+
+        if min_bpp:
+            bit_rate=self.__media_info.get_video_bit_rate()
+            width,height=self.__media_info.get_dimensions()
+            frame_rate=self.__media_info.get_frame_rate()
+            if bit_rate and width and height and frame_rate:
+                bpp=bit_rate/(width*height*frame_rate)
+                if bpp < min_bpp:
+                    return _('{:.4f} bits per pixel, below {:g}').format(bpp,min_bpp)
+
+        output_filename=os.path.splitext(self.__in_filename)[0]+postfix+'.mkv'
+        if os.path.isfile(output_filename):
+            return _('{} already exists').format(output_filename)
+
+        return None
+
+    def get_previous_output(self):
+        """Returns the output of a previous successful run over this same (unchanged) file, if it still exists.
+        
+        """
+        if self.__cache:
+            outcome=self.__cache.get(self.__in_filename,'outcome')
+            if outcome and outcome.get('ok') and os.path.isfile(outcome.get('output','')):
+                return outcome['output']
+
+        return None
     
 
     def __find_ext_subtitle(self):
@@ -120,22 +686,82 @@ class Video:
                     return
 
     def __try_to_convert_sub_to_srt(self):
-        for sub_file in self.__sub_files:
-            subtitle_filename_root,subtitle_filename_ext=os.path.splitext(sub_file)
-            
-            if subtitle_filename_ext == '.srt':
-                continue
-            
-            srt_sub_file=ass2srt(sub_file)
-            if srt_sub_file:
-                self.__int_sub_files.append(srt_sub_file)   
-                
-    def set_transcoding_options(self,preset,crf,replace_original,avlang,slang,postfix,threads,auto_crop):
+        """Replaces the ASS/SSA subtitles by temporary SRT conversions of them. The original external files are kept.
+        
+        """
+        for sub_files in (self.__ext_sub_files,self.__int_sub_files):
+            for position,sub_file in enumerate(list(sub_files)):
+                if os.path.splitext(sub_file)[1].lower() not in ('.ass','.ssa') or not os.path.isfile(sub_file):
+                    continue
+
+                self.__find_sub_charset(sub_file)
+                charset=self.__sub_charsets.get(sub_file)
+                if charset in (None,'binary'):
+                    charset='utf-8'
+
+                if sub_files is self.__int_sub_files:
+                    srt_sub_file=os.path.splitext(sub_file)[0]+'.srt' # The extracted track, that is replaced.
+
+                else:
+                    srt_sub_file=self.__tmp_root + '_ext_sub{:d}.srt'.format(position)
+
+                try:
+                    srt_sub_file=ass2srt(sub_file,srt_sub_file,charset)
+
+                except (OSError,LookupError) as error:
+                    sys.stderr.write(_("WARNING: Subtitle file {} could not be converted to SRT: {}\n").format(sub_file,error))
+                    continue
+
+                if not srt_sub_file:
+                    continue
+
+                if sub_file in self.__slangs:
+                    self.__slangs[srt_sub_file]=self.__slangs[sub_file]
+
+                if sub_files is self.__int_sub_files:
+                    self.__int_sub_files[position]=srt_sub_file
+                    os.remove(sub_file)
+
+                else:
+                    self.__ext_sub_files[position]=srt_sub_file # Removed by clean(), as it starts with the temporary root.
+
+
+    def set_output_check(self,output_check):
+        """Sets a function called once the output is complete, before putting it in place, that discards it if it returns False.
+        
+        """
+        self.__output_check=output_check
+
+    def set_transcoding_options(self,preset,crf,replace_original,avlang,slang,postfix,threads,auto_crop,quiet=False,chunks=1,crop_samples=5,crop_spread=0.9,crop_seed=None,mux='ffmpeg',telemetry=None,max_size_ratio=None,journal=None,to_srt=False,audio_codec='aac',audio_bitrate=None,separate_audio=False,target_size=None,target_bitrate=None,scratch_dir=None):
         if self.__in_ok:
+            self.__target_size = target_size
+            self.__target_bitrate = target_bitrate
+            self.__scratch_dir=scratch_dir
+            if scratch_dir:
+                self.__tmp_root=os.path.join(scratch_dir,os.path.basename(self.__local_tmp_root))
+                self.__ffmpeg_output=self.__tmp_root+self.__ffmpeg_output_ext
+                self.__work_output=self.__tmp_root+'_output'+self.__ffmpeg_output_ext
+
+            process_runner.add_temporary_root(self.__tmp_root) # Removed at exit even if clean() is never reached.
+            process_runner.add_temporary_root(self.__local_tmp_root)
+            self.__audio_codec = audio_codec
+            self.__audio_bitrate = audio_bitrate or {'aac':96,'opus':64}[audio_codec]
+            self.__separate_audio = separate_audio
             self.__preset = preset			
             self.__CRF = crf
-            self.__find_ext_subtitle()
-            self.__find_int_subtitles()
+            self.__mux = mux
+            self.__to_srt = to_srt
+            self.__telemetry = telemetry
+            self.__max_size_ratio = max_size_ratio
+            self.__journal = journal
+            with StageTimer(self.__stages,'subtitles'):
+                self.__find_ext_subtitle()
+                self.__direct_mux = self.__can_mux_directly()
+                if not self.__direct_mux:
+                    self.__find_int_subtitles() # Only mkvmerge needs them extracted.
+
+                if to_srt:
+                    self.__try_to_convert_sub_to_srt()
 
             self.__replace_original = replace_original            
             self.__default_avlang = avlang
@@ -143,103 +769,532 @@ class Video:
 ##            self.__sub_exts.append(extra_sub_ext)
             self.__output_postfix = postfix
             self.__threads = threads
+            self.__quiet = quiet
+            self.__chunks = chunks
+            self.__crop_samples = crop_samples
+            self.__crop_spread = crop_spread
+            self.__crop_seed = crop_seed
             if auto_crop:
                 sys.stdout.write(_('Finding crop dimensions...'))
                 sys.stdout.flush()
-                self.__get_crop_data()
+                with StageTimer(self.__stages,'crop'):
+                    self.__get_crop_data()
                 
             self.__transcoding_options_set = True
             
+    def __can_mux_directly(self):
+        """Returns True if ffmpeg can write the final MKV with all the subtitles, without an intermediate file.
+        
+        """
+        if self.__mux != 'ffmpeg':
+            return False
+
+        for sub_file in self.__ext_sub_files:
+            if os.path.splitext(sub_file)[1].lower() not in self.__ffmpeg_sub_exts:
+                return False
+
+        if os.path.splitext(self.__in_filename)[1] == '.mkv': # Otherwise mkvmerge would not keep internal subtitles anyway.
+            for subtitle_stream in self.__media_info.get_subtitle_streams():
+                if subtitle_stream.codec not in self.__ffmpeg_sub_codecs:
+                    return False
+
+                if self.__to_srt and subtitle_stream.codec in ('ass','ssa'):
+                    return False # They must be extracted to be converted.
+
+        return True
+
+    def __subtitle_mux_args(self,first_input,source_input=None):
+        """Returns the ffmpeg input and output arguments to put all the subtitles in the final file.
+
+        External subtitle files are added as inputs starting at index first_input. The internal ones are
+        taken from input source_input, or the original file is added as one more input if it is None.
+        """
+        input_args=[]
+        output_args=[]
+        sub_counter=0
+        int_sub_streams=[stream for stream in self.__media_info.get_subtitle_streams() if stream.codec in self.__ffmpeg_sub_codecs]
+        if int_sub_streams and source_input is None:
+            input_args+=['-i', self.__in_filename]
+            source_input=first_input
+            first_input+=1
+
+        for subtitle_stream in int_sub_streams:
+            output_args+=['-map', '{:d}:{:d}'.format(source_input,subtitle_stream.index), '-c:s:{:d}'.format(sub_counter), self.__ffmpeg_sub_codecs[subtitle_stream.codec]]
+            output_args+=['-metadata:s:s:{:d}'.format(sub_counter), 'language={}'.format(subtitle_stream.language or self.__default_slang)]
+            sub_counter+=1
+
+        for sub_file in self.__ext_sub_files:
+            input_args+=['-i', self.__utf8_subtitle(sub_file)]
+            output_args+=['-map', '{:d}:0'.format(first_input), '-c:s:{:d}'.format(sub_counter), 'copy']
+            output_args+=['-metadata:s:s:{:d}'.format(sub_counter), 'language={}'.format(self.__default_slang)]
+            first_input+=1
+            sub_counter+=1
+
+        return input_args,output_args
+
+    def __utf8_subtitle(self,sub_file):
+        """Returns sub_file, or a temporary UTF-8 copy of it if it has another charset (MKV text subtitles must be UTF-8).
+        
+        """
+        self.__find_sub_charset(sub_file)
+        charset=self.__sub_charsets.get(sub_file)
+        if charset in (None,'utf-8','us-ascii','binary'):
+            return sub_file
+
+        try:
+            with open(sub_file,'r',encoding=charset) as in_file:
+                text=in_file.read()
+
+        except (LookupError,UnicodeDecodeError):
+            return sub_file
+
+        utf8_sub_file=self.__tmp_root + '_sub{:d}'.format(len(self.__int_sub_files)) + os.path.splitext(sub_file)[1]
+        with open(utf8_sub_file,'w',encoding='utf-8') as out_file:
+            out_file.write(text)
+
+        self.__int_sub_files.append(utf8_sub_file)
+        return utf8_sub_file
+
+    def __stream_language_args(self):
+        avlang=self.__avlang or self.__default_avlang
+        args=['-metadata:s:v:0', 'language={}'.format(avlang)]
+        for audio_counter,audio_stream in enumerate(self.__media_info.get_audio_streams()):
+            if not audio_stream.language:
+                args+=['-metadata:s:a:{:d}'.format(audio_counter), 'language={}'.format(avlang)] # As mkvmerge --default-language does.
+
+        return args
+
+    def __audio_plan(self):
+        """Returns a list of (stream, codec, bit rate) with what to do with each audio stream: 'copy' or the encoder to use.
+
+        AAC and Opus streams are copied unless their bit rate is well above the one they would be
+        transcoded to, since transcoding them again would lose quality to save little space.
+        """
+        plan=[]
+        for audio_stream in self.__media_info.get_audio_streams():
+            channels=audio_stream.channels or 2
+            bit_rate=min(channels,8)*self.__audio_bitrate*1000
+            if audio_stream.codec in ('aac','opus') and (not audio_stream.bit_rate or audio_stream.bit_rate <= 1.5*bit_rate):
+                plan.append((audio_stream,'copy',None))
+
+            else:
+                plan.append((audio_stream,self.__audio_encoders[self.__audio_codec],bit_rate))
+
+        return plan
+
+    def __audio_must_be_encoded(self):
+        return any(codec != 'copy' for audio_stream,codec,bit_rate in self.__audio_plan())
+
+    def __get_output_name(self):
+        mkv_output=os.path.splitext(self.__in_filename)[0]+self.__output_postfix+'.mkv'
+        while os.path.isfile(mkv_output):
+            mkv_output = mkv_output.replace(self.__output_postfix, '_' + self.__output_postfix)
+
+        return mkv_output
+
     def __find_int_subtitles(self):
-            n = 1
-            in_filename_root,in_filename_ext=os.path.splitext(self.__in_filename)
-            if in_filename_ext == '.mkv':
-                for line in os.popen("mkvmerge -i \"{}\" -F verbose-text".format(self.__in_filename)):
-                    if 'subtitles' in line:
-                        track_id=int(line.strip().split(":")[0].split()[-1])
-                        sub_type=line.strip().split('(')[1].split(")")[0]
-                        slang = line[line.index("language:"):].split(':')[1].split()[0]
-                        if slang:
-                            if "unk" in slang.lower() or "und" in slang.lower():
-                                    slang = None
-
-                        sub_ext='.srt'
-                        if sub_type in ['ASS','SSA', 'SubStationAlpha']:
-                            sub_ext='.ass'
-                            
-                        #while(os.path.isfile(in_filename_root+"_"+str(n)+sub_ext)):
-                        #    n+=1
-                            
-                        sub_filename = in_filename_root + "_tmp_" + random_string(10) + sub_ext
-                            
-                        os.system("mkvextract tracks \"{}\" {:d}:\"{}\"".format(self.__in_filename, track_id, sub_filename))
-                        
-                        self.__int_sub_files.append(sub_filename)
-                        
-                        if slang:
-                            self.__slangs[sub_filename] = slang
-                        
-                        
+        """Extracts all the subtitle tracks of an MKV input with a single mkvextract run, that reads the file once.
+        
+        """
+        if os.path.splitext(self.__in_filename)[1] != '.mkv':
+            return
+
+        track_args=[]
+        for subtitle_stream in self.__media_info.get_subtitle_streams():
+            sub_ext=self.__int_sub_exts.get(subtitle_stream.codec,'.srt')
+            sub_filename = self.__tmp_root + '_sub{:d}'.format(len(self.__int_sub_files)) + sub_ext
+            track_args.append('{:d}:{}'.format(subtitle_stream.index, sub_filename)) # Matroska track IDs are the same as ffprobe stream indexes.
+            self.__int_sub_files.append(sub_filename)
+            if subtitle_stream.language:
+                self.__slangs[sub_filename] = subtitle_stream.language
+
+        if track_args:
+            process_runner.run(['mkvextract', 'tracks', self.__in_filename] + track_args)
+            self.__int_sub_files=[sub_filename for sub_filename in self.__int_sub_files if os.path.isfile(sub_filename)]
+
+    def __video_map(self):
+        return '0:{:d}'.format(self.__media_info.get_video_index())
+
+    def __video_encoding_args(self,two_pass=None):
+        """Returns the x265 arguments, for CRF or, if two_pass is 1 or 2, for that pass of the target size or bit rate mode.
+        
+        """
+        if not two_pass:
+            args=['-c:v', 'libx265', '-preset', self.__preset, '-crf', str(self.__CRF)]
+
+        elif two_pass == 1:
+            args=['-c:v', 'libx265', '-preset', self.__preset, '-b:v', str(self.__video_bit_rate), '-x265-params', 'pass=1:stats={0}.log:analysis-save={0}.dat:analysis-save-reuse-level={1:d}'.format(self.__two_pass_root,self.__analysis_reuse_level)]
+
+        else:
+            args=['-c:v', 'libx265', '-preset', self.__preset, '-b:v', str(self.__video_bit_rate), '-x265-params', 'pass=2:stats={0}.log:analysis-load={0}.dat:analysis-load-reuse-level={1:d}'.format(self.__two_pass_root,self.__analysis_reuse_level)]
+
+        if self.__crop_data:
+            args+=['-vf', 'crop={}'.format(self.__crop_data)]
+
+        return args
+
+    def __audio_encoding_args(self,input_index=0):
+        """Returns the ffmpeg arguments to map all the audio streams of input input_index, copying or encoding each one.
+        
+        """
+        args=[]
+        for audio_counter,(audio_stream,codec,bit_rate) in enumerate(self.__audio_plan()):
+            args+=['-map', '{:d}:{:d}'.format(input_index,audio_stream.index), '-c:a:{:d}'.format(audio_counter), codec]
+            if codec != 'copy':
+                args+=['-ar:a:{:d}'.format(audio_counter), '48k', '-b:a:{:d}'.format(audio_counter), str(bit_rate)]
+
+        return args
+
     def transcode(self):
         if self.__transcoding_options_set:
-            #cmd_line='ffmpeg -i \"{}\" -vcodec libx265 -crf {:d}'.format(self.__in_filename, self.__CRF)
-            cmd_line='ffmpeg -i \"{}\" -c:v libx265 -preset {} -crf {:d}'.format(self.__in_filename, self.__preset, self.__CRF)
-            if self.__crop_data:
-                cmd_line+=' -vf crop={}'.format(self.__crop_data)
-                
-            #cmd_line+=' -acodec aac -ar 48k -ab 192k -strict experimental -sn -threads {:d} -y \"{}\"'.format(self.__threads, self.__ffmpeg_output)
-            cmd_line+=' -c:a aac -ar 48k -b:a 192k -strict experimental -max_muxing_queue_size 9999 -sn -threads {:d} -y \"{}\"'.format(self.__threads, self.__ffmpeg_output)
-            
-            sys.stdout.write('> {}\n'.format(cmd_line))
-            exit_code=os.system(cmd_line)
+            if not self.__has_enough_space():
+                return False
+
+            if self.__journal:
+                self.__journal.record(self.__in_filename,'encoding',tmp_root=self.__tmp_root)
+
+            if self.__telemetry:
+                self.__progress=self.__telemetry.start_file(self.__in_filename,self.__in_duration)
+
+            with StageTimer(self.__stages,'encode'):
+                if self.__target_size or self.__target_bitrate:
+                    transcoded=self.__transcode_in_two_passes()
+
+                else:
+                    transcoded=self.__encode()
+
+            if self.__progress:
+                self.__progress.finish(transcoded)
             
-            if not exit_code:
-                if not self.__create_complete_mkv():
+            if transcoded:
+                if self.__journal:
+                    self.__journal.record(self.__in_filename,'muxing',tmp_root=self.__local_tmp_root) # The output may be copied next to the input with this prefix.
+
+                if not self.__direct_mux:
+                    with StageTimer(self.__stages,'mux'):
+                        muxed=self.__create_complete_mkv()
+
+                    if not muxed:
+                        self.__save_outcome(False)
+                        return False
+
+                if not self.__output_is_small_enough():
+                    return False
+
+                if self.__output_check and not self.__output_check():
+                    sys.stderr.write(_("WARNING: Discarding the output of {}, it is not wanted anymore.\n").format(self.__in_filename))
+                    os.remove(self.__work_output)
+                    self.__save_outcome(False)
+                    return False
+
+                self.__output_filename=self.__get_output_name()
+                try:
+                    with StageTimer(self.__stages,'mux'):
+                        move_file(self.__work_output,self.__output_filename,self.__local_tmp_root+'_output'+self.__ffmpeg_output_ext)
+
+                except OSError as error:
+                    sys.stderr.write(_("ERROR: {} could not be moved to {}: {}\n").format(self.__work_output,self.__output_filename,error))
+                    self.__output_filename=None
+                    self.__save_outcome(False)
                     return False
                 
+                self.__save_outcome(True)
+                if self.__two_pass_dir:
+                    self.__remove_two_pass_files() # The ones in the cache are kept to retry with another target, see --cache-data-size.
                 if self.__replace_original:
                     sys.stderr.write(_("WARNING: Deleting file {} as commanded with -r option.\nThis file won't be easily recovered.\n").format(self.__in_filename))
                     os.remove(self.__in_filename)
                         
                 return True
 
-            #else:
-            #    os.remove(self.__ffmpeg_output)
-            #    self.__fmpeg_output = None
-        
+            self.__output_filename=None
+            self.__save_outcome(False)
+
         return False
-    
-    def __create_complete_mkv(self):
-        if self.__ffmpeg_output:
-            ffmpeg_output_root=os.path.splitext(self.__ffmpeg_output)[0].replace(self.__ffmpeg_output_postfix,'')
-            mkv_output=ffmpeg_output_root+self.__output_postfix+'.mkv'
-            while os.path.isfile(mkv_output):
-                mkv_output = mkv_output.replace(self.__output_postfix, '_' + self.__output_postfix)
 
-            if not self.__avlang:
-                self.__avlang = self.__default_avlang
-                
-            cmd_line="mkvmerge --default-language {} -o \"{}\" \"{}\"".format(self.__avlang,mkv_output,self.__ffmpeg_output)
-            sub_files = self.__ext_sub_files + self.__int_sub_files
-            if sub_files:
-                for sub_file in sub_files:
-                    if sub_file in self.__slangs:
-                        slang = self.__slangs[sub_file]
-                        
+    def __encode(self):
+        if (self.__chunks > 1 and self.__in_duration) or (self.__separate_audio and self.__audio_must_be_encoded()):
+            return self.__transcode_in_chunks()
+
+        return self.__transcode_in_one_pass()
+
+    def __transcode_in_two_passes(self):
+        """Encodes the video with the bit rate that makes the output fit the target size (or with the target bit rate).
+
+        The first pass keeps the x265 statistics and analysis (motion search and mode decisions) in the
+        cache directory, so a retry with another target only runs the second pass. If the output is
+        still too big, the second pass is repeated with a corrected bit rate.
+        """
+        if not self.__in_duration:
+            sys.stderr.write(_("ERROR: The duration of {} is unknown, so its bit rate can not be computed.\n").format(self.__in_filename))
+            return False
+
+        self.__video_bit_rate=self.__target_video_bit_rate()
+        if self.__video_bit_rate < 10000:
+            sys.stderr.write(_("ERROR: The target size of {} leaves no room for the video.\n").format(self.__in_filename))
+            return False
+
+        self.__two_pass_root=None
+        if self.__cache:
+            self.__two_pass_root=self.__cache.get_data_filename(self.__in_filename,'2pass_{}_{}'.format(self.__preset,self.__crop_data))
+
+        if not self.__two_pass_root or ':' in self.__two_pass_root:
+            import tempfile
+            scratch_dir=self.__scratch_dir if self.__scratch_dir and ':' not in self.__scratch_dir else None # The system temporary directory otherwise.
+            self.__two_pass_dir=tempfile.mkdtemp(prefix='transcode2H265_2pass_',dir=scratch_dir)
+            self.__two_pass_root=os.path.join(self.__two_pass_dir,'2pass')
+            process_runner.add_temporary_root(self.__two_pass_root)
+
+        if ':' in self.__two_pass_root:
+            sys.stderr.write(_("ERROR: The path of the two pass files, {}, can not contain ':' as x265 uses it as separator.\n").format(self.__two_pass_root))
+            self.__remove_two_pass_files()
+            return False
+
+        if os.path.isfile(self.__two_pass_root+'.log') and os.path.isfile(self.__two_pass_root+'.dat'):
+            sys.stdout.write(_('Reusing the first pass analysis of a previous run.\n'))
+
+        else:
+            sys.stdout.write(_('First pass, with {:d} kb/s...\n').format(self.__video_bit_rate//1000))
+            cmd=['ffmpeg', '-nostdin', '-loglevel', 'error', '-i', self.__in_filename, '-map', self.__video_map()] + self.__video_encoding_args(1) + ['-an', '-sn', '-threads', str(self.__threads), '-f', 'null', '-']
+            sys.stdout.write('> {}\n'.format(shlex.join(cmd)))
+            if run_ffmpeg(cmd):
+                self.__remove_two_pass_files()
+                return False
+
+        self.__two_pass_stage=2
+        try:
+            for attempt in range(self.__two_pass_attempts):
+                sys.stdout.write(_('Second pass, with {:d} kb/s...\n').format(self.__video_bit_rate//1000))
+                if not self.__encode():
+                    return False
+
+                out_size=os.path.getsize(self.__work_output if self.__direct_mux else self.__ffmpeg_output)
+                if not self.__target_size or out_size <= self.__target_size or attempt == self.__two_pass_attempts-1:
+                    break
+
+                sys.stderr.write(_("WARNING: The output is {:.1%} over the target size, encoding again.\n").format(out_size/self.__target_size-1))
+                self.__video_bit_rate=int(self.__video_bit_rate*self.__target_size/out_size*0.98)
+
+        finally:
+            self.__two_pass_stage=None
+
+        return True
+
+    def __target_video_bit_rate(self):
+        """Returns the video bit rate, in b/s, for the target bit rate, or to fit the target size together with the audio.
+        
+        """
+        if self.__target_bitrate:
+            return self.__target_bitrate*1000
+
+        audio_bit_rate=0
+        for audio_stream,codec,bit_rate in self.__audio_plan():
+            audio_bit_rate+=bit_rate or audio_stream.bit_rate or (audio_stream.channels or 2)*self.__audio_bitrate*1000
+
+        return int(self.__target_size*8*0.98/self.__in_duration)-audio_bit_rate # 2% for the container.
+
+    def __remove_two_pass_files(self):
+        if self.__two_pass_root:
+            for extension in ('.log','.log.cutree','.log.temp','.log.cutree.temp','.dat'):
+                if os.path.isfile(self.__two_pass_root+extension):
+                    os.remove(self.__two_pass_root+extension)
+
+        if self.__two_pass_dir:
+            process_runner.discard_temporary_root(self.__two_pass_root)
+            if os.path.isdir(self.__two_pass_dir):
+                os.rmdir(self.__two_pass_dir)
+
+            self.__two_pass_dir=None
+
+    def __transcode_in_one_pass(self):
+        cmd=['ffmpeg', '-nostdin', '-i', self.__in_filename]
+        if self.__direct_mux:
+            sub_input_args,sub_output_args=self.__subtitle_mux_args(1,0)
+            cmd+=sub_input_args + ['-map', self.__video_map()] + self.__audio_encoding_args() # Every stream is mapped by index, so attached pictures are left out.
+            cmd+=sub_output_args + self.__stream_language_args()
+
+        else:
+            cmd+=['-map', self.__video_map()] + self.__audio_encoding_args()
+
+        cmd+=self.__video_encoding_args(self.__two_pass_stage)
+        if self.__quiet:
+            cmd+=['-loglevel', 'error'] # Several jobs share the terminal, so ffmpeg progress lines would be garbled.
+
+        cmd+=['-max_muxing_queue_size', '9999', '-threads', str(self.__threads)]
+        if self.__direct_mux:
+            cmd+=['-y', self.__work_output]
+
+        else:
+            cmd+=['-sn', '-y', self.__ffmpeg_output]
+
+        sys.stdout.write('> {}\n'.format(shlex.join(cmd)))
+        return not run_ffmpeg(cmd,self.__progress)
+
+    def __output_is_small_enough(self):
+        """Discards the output if it is not smaller than max_size_ratio times the input.
+        
+        """
+        if not self.__max_size_ratio:
+            return True
+
+        in_size=os.path.getsize(self.__in_filename)
+        out_size=os.path.getsize(self.__work_output)
+        if out_size <= in_size*self.__max_size_ratio:
+            return True
+
+        self.__skip_reason=_('output size is {:.0%} of the original, above {:.0%}').format(out_size/in_size,self.__max_size_ratio)
+        sys.stderr.write(_("WARNING: Discarding the output of {}, its size is {:.0%} of the original.\n").format(self.__in_filename,out_size/in_size))
+        os.remove(self.__work_output)
+        return False
+
+    def __estimate_output_size(self):
+        in_size=os.path.getsize(self.__in_filename)
+        if self.__target_size:
+            return self.__target_size
+
+        if self.__target_bitrate and self.__in_duration:
+            return int(self.__in_duration*self.__target_bitrate*1000/8*1.1) # Audio and container included, roughly.
+
+        return int(in_size*max(self.__max_size_ratio or 1,1)) # Bigger outputs are usually discarded.
+
+    def __has_enough_space(self):
+        """Checks that the scratch and output directories have room for the estimated temporary files and output.
+        
+        """
+        in_size=os.path.getsize(self.__in_filename)
+        out_size=self.__estimate_output_size()
+        scratch_size=out_size # The output, until it is moved into place.
+        if not self.__direct_mux:
+            scratch_size+=out_size # The file for mkvmerge.
+
+        if self.__chunks > 1:
+            scratch_size+=in_size+out_size # The pieces of the original video, and encoded.
+
+        elif self.__separate_audio:
+            scratch_size+=out_size # The video encoded apart from the audio.
+
+        needs=collections.OrderedDict()
+        for directory,size in ((os.path.dirname(self.__tmp_root) or '.',scratch_size),(os.path.dirname(self.__local_tmp_root) or '.',out_size)):
+            device=os.stat(directory).st_dev
+            if device not in needs: # In the same filesystem the output is just renamed, it needs no more room.
+                needs[device]=[directory,size]
+
+        for directory,size in needs.values():
+            free=shutil.disk_usage(directory).free
+            if free < size:
+                sys.stderr.write(_("ERROR: {} needs about {:.1f} MiB in {}, but there are only {:.1f} MiB free.\n").format(self.__in_filename,size/2**20,directory,free/2**20))
+                return False
+
+        return True
+
+    def __save_outcome(self,ok):
+        if self.__cache:
+            self.__cache.set(self.__in_filename,'outcome',{'ok': ok, 'output': self.__output_filename})
+
+    def __transcode_in_chunks(self):
+        """Splits the video stream at keyframes, encodes the pieces in parallel and joins them again.
+
+        Audio is encoded once for the whole file, so the chunk boundaries cause no gaps in it, and in
+        its own process, so it is not in the critical path of the video encoders. With a single chunk
+        the video is encoded straight from the input, without splitting it.
+        """
+        tmp_root=self.__tmp_root
+        chunk_pattern=tmp_root+'_chunk_%03d.mkv'
+        concat_list=tmp_root+'_chunks.txt'
+        audio_output=tmp_root+'_audio.mka'
+        tmp_files=[concat_list, audio_output]
+        budget=self.__threads or os.cpu_count() or 1
+        chunk_threads=max(1,budget//self.__chunks)
+        try:
+            if self.__chunks > 1:
+                cmd=['ffmpeg', '-nostdin', '-loglevel', 'error', '-i', self.__in_filename, '-map', self.__video_map(), '-c', 'copy', '-f', 'segment', '-segment_time', '{:.3f}'.format(self.__in_duration/self.__chunks), '-reset_timestamps', '1', '-y', chunk_pattern]
+                sys.stdout.write('> {}\n'.format(shlex.join(cmd)))
+                if run_ffmpeg(cmd):
+                    return False
+
+                chunk_prefix=os.path.basename(tmp_root)+'_chunk_'
+                chunk_dir=os.path.dirname(chunk_pattern) or '.'
+                chunks=sorted(os.path.join(chunk_dir,filename) for filename in os.listdir(chunk_dir) if filename.startswith(chunk_prefix))
+                tmp_files+=chunks
+                encoded_chunks=[os.path.splitext(chunk)[0]+'_h265.mkv' for chunk in chunks]
+                video_map='0:v:0' # The chunks only have the video stream.
+                sys.stdout.write(_('Encoding {:d} chunks with {:d} threads each.\n').format(len(chunks),chunk_threads))
+
+            else:
+                chunks=[self.__in_filename]
+                encoded_chunks=[tmp_root+'_video.mkv']
+                video_map=self.__video_map()
+                sys.stdout.write(_('Encoding the audio in its own process.\n'))
+
+            tmp_files+=encoded_chunks
+            jobs=[]
+            import concurrent.futures
+            with concurrent.futures.ThreadPoolExecutor(max_workers=len(chunks)+1) as executor:
+                if self.__media_info.get_audio_streams():
+                    cmd=['ffmpeg', '-nostdin', '-loglevel', 'error', '-i', self.__in_filename] + self.__audio_encoding_args() + ['-vn', '-sn', '-y', audio_output]
+                    sys.stdout.write('> {}\n'.format(shlex.join(cmd)))
+                    jobs.append(executor.submit(run_ffmpeg,cmd))
+
+                for chunk_number,(chunk,encoded_chunk) in enumerate(zip(chunks,encoded_chunks)):
+                    cmd=['ffmpeg', '-nostdin', '-loglevel', 'error', '-i', chunk, '-map', video_map] + self.__video_encoding_args(self.__two_pass_stage) + ['-an', '-sn', '-threads', str(chunk_threads), '-y', encoded_chunk]
+                    sys.stdout.write('> {}\n'.format(shlex.join(cmd)))
+                    jobs.append(executor.submit(run_ffmpeg,cmd,self.__progress,chunk_number))
+
+            if any(job.result() for job in jobs):
+                return False
+
+            with open(concat_list,'w') as list_file:
+                for encoded_chunk in encoded_chunks:
+                    list_file.write("file '{}'\n".format(os.path.abspath(encoded_chunk).replace("'","'\\''")))
+
+            cmd=['ffmpeg', '-nostdin', '-loglevel', 'error', '-f', 'concat', '-safe', '0', '-i', concat_list]
+            maps=['-map', '0:v']
+            if self.__media_info.get_audio_streams():
+                cmd+=['-i', audio_output]
+                maps+=['-map', '1:a']
+
+            if self.__direct_mux:
+                sub_input_args,sub_output_args=self.__subtitle_mux_args(len(maps)//2)
+                cmd+=sub_input_args
+                maps+=sub_output_args + self.__stream_language_args()
+
+            cmd+=maps + ['-c:v', 'copy', '-c:a', 'copy', '-max_muxing_queue_size', '9999', '-y', self.__work_output if self.__direct_mux else self.__ffmpeg_output]
+            sys.stdout.write('> {}\n'.format(shlex.join(cmd)))
+            return not run_ffmpeg(cmd)
+
+        finally:
+            for tmp_file in tmp_files:
+                if os.path.isfile(tmp_file):
+                    os.remove(tmp_file)
+    
+    def __create_complete_mkv(self):
+        if self.__ffmpeg_output:
+            mkv_output=self.__work_output
+
+            if not self.__avlang:
+                self.__avlang = self.__default_avlang
+                
+            cmd=['mkvmerge', '--default-language', self.__avlang, '-o', mkv_output, self.__ffmpeg_output]
+            sub_files = self.__ext_sub_files + self.__int_sub_files
+            if sub_files:
+                for sub_file in sub_files:
+                    if sub_file in self.__slangs:
+                        slang = self.__slangs[sub_file]
+                        
                     else:
                         slang = self.__default_slang
                         
-                    cmd_line+="  --language 0:{}".format(slang)
+                    cmd+=['--language', '0:{}'.format(slang)]
                     self.__find_sub_charset(sub_file)
-                    if self.__sub_charsets[sub_file]:
-                        cmd_line+=" --sub-charset 0:{}".format(self.__sub_charsets[sub_file])
+                    if self.__sub_charsets[sub_file] not in (None,'binary'):
+                        cmd+=['--sub-charset', '0:{}'.format(self.__sub_charsets[sub_file])]
                         
-                    cmd_line+=(" \"{}\" ".format(sub_file))
+                    cmd.append(sub_file)
                 
                 
-            sys.stdout.write('> {}\n'.format(cmd_line))
-            exit_status=os.system(cmd_line)
-            if not exit_status:
+            sys.stdout.write('> {}\n'.format(shlex.join(cmd)))
+            exit_status=process_runner.run(cmd).returncode
+            if exit_status in (0,1): # 1 means there were only warnings.
                 #os.remove(self.__ffmpeg_output)
                 #self.__ffmpeg_output=None
                 return True        
@@ -247,49 +1302,147 @@ class Video:
         return False
     
     def __find_sub_charset(self, filename):
-        cmd_output=os.popen("file -bi \"{}\" | sed -e 's/.*charset=//'".format(filename))
-        for line in cmd_output:
-            line=line.strip()
-            if line:
-                self.__sub_charsets[filename]=line
+        if filename not in self.__sub_charsets:
+            self.__sub_charsets[filename]=detect_charset(filename)
         
     def __get_crop_data(self):
+        cache_key='crop_{:d}_{:g}_{}'.format(self.__crop_samples,self.__crop_spread,self.__crop_seed)
+        if self.__cache:
+            cached_crop=self.__cache.get(self.__in_filename,cache_key)
+            if cached_crop is not None:
+                sys.stdout.write('{}\n'.format(cached_crop['crop']))
+                self.__crop_data=cached_crop['crop']
+                return
+
         crop_data=None
-        crop_list=[]
-        tmp_output_filename=os.path.splitext(self.__in_filename)[0] + '_tmp_' + random_string(10)  +'_autocrop.mkv'
-        input_duration=self.__in_duration
-        if input_duration:
-            ss_list=[input_duration/x for x in random.sample(range(1,100),5)] # Cheacking autocrop in 5 random sites in the video.
-            for ss in ss_list:
-                cproc = subprocess.run(["ffmpeg", "-ss", str(ss), "-i", self.__in_filename, "-t", "1", "-filter", "cropdetect", "-y", tmp_output_filename], stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
-                for line in cproc.stderr.split('\n'):
-                    line=line.strip()
-                    if ('cropdetect' in line) and ('=' in line):
-                        crop_list.append(line.split('=')[1])
-                        
-            os.remove(tmp_output_filename)            
-            crop_set=set(crop_list)
-            crop_mode_cont=0
-            for crop in crop_set:
-                if crop_list.count(crop) > crop_mode_cont:
-                    crop_data=crop
-                    crop_mode_cont=crop_list.count(crop)
+        if self.__in_duration:
+            crop_data=detect_crop(self.__in_filename,crop_sample_times(self.__in_duration,self.__crop_samples,self.__crop_spread,self.__crop_seed),video_index=self.__media_info.get_video_index())
             
         sys.stdout.write('{}\n'.format(crop_data))
         self.__crop_data=crop_data
+        if self.__cache and self.__in_duration:
+            self.__cache.set(self.__in_filename,cache_key,{'crop': crop_data})
         
     def __purge_int_sub_files(self):
-        if self.__int_sub_files:
-            for sub_file in self.__int_sub_files:
+        for sub_file in self.__int_sub_files + [sub_file for sub_file in self.__ext_sub_files if sub_file.startswith(self.__tmp_root)]:
+            if os.path.isfile(sub_file):
                 print(_("Removing temporary file '{}'.").format(sub_file))
                 os.remove(sub_file)
                 
     def clean(self):
-        print(_("Removing temporary file '{}'.").format(self.__ffmpeg_output))
-        os.remove(self.__ffmpeg_output)
+        if self.__ffmpeg_output and os.path.isfile(self.__ffmpeg_output):
+            print(_("Removing temporary file '{}'.").format(self.__ffmpeg_output))
+            os.remove(self.__ffmpeg_output)
+
         self.__ffmpeg_output = None
+        if os.path.isfile(self.__work_output):
+            print(_("Removing temporary file '{}'.").format(self.__work_output))
+            os.remove(self.__work_output)
+
+        if self.__two_pass_dir:
+            self.__remove_two_pass_files()
+
         self.__purge_int_sub_files()
+        process_runner.discard_temporary_root(self.__tmp_root)
+        process_runner.discard_temporary_root(self.__local_tmp_root)
     
+class Journal:
+    """Append-only record of the state of every file of a batch, so an interrupted batch can be resumed.
+
+    Each state change is a JSON line written with a single write() call and flushed to disk with
+    fsync(), so after a crash the journal holds every state reached, at most missing the last one.
+    """
+    def __init__(self,filename):
+        self.__filename=filename
+        self.__lock=threading.Lock()
+        self.__records={} # Last known state of each file, merged with the details of the previous ones.
+        self.__files=[]
+
+    def start(self,filenames):
+        """Begins a new batch, replacing any previous journal.
+        
+        """
+        os.makedirs(os.path.dirname(os.path.abspath(self.__filename)),exist_ok=True)
+        tmp_filename=self.__filename+'.tmp.{:d}'.format(os.getpid())
+        with open(tmp_filename,'w') as journal_file:
+            journal_file.write(json.dumps({'time': time.time(), 'state': 'batch', 'files': [os.path.abspath(filename) for filename in filenames]})+'\n')
+            journal_file.flush()
+            os.fsync(journal_file.fileno())
+
+        os.replace(tmp_filename,self.__filename)
+        self.__files=[os.path.abspath(filename) for filename in filenames]
+
+    def load(self):
+        """Reads the journal of a previous batch. Returns False if there is none.
+        
+        """
+        if not os.path.isfile(self.__filename):
+            return False
+
+        with open(self.__filename) as journal_file:
+            for line in journal_file:
+                try:
+                    record=json.loads(line)
+
+                except ValueError:
+                    continue # A line cut by the crash.
+
+                if record.get('state') == 'batch':
+                    self.__files=record['files']
+                    continue
+
+                previous_record=self.__records.get(record['file'],{'tmp_roots': []})
+                if record.get('tmp_root'):
+                    previous_record['tmp_roots'].append(record.pop('tmp_root'))
+
+                previous_record.update(record)
+                self.__records[record['file']]=previous_record
+
+        return True
+
+    def get_files(self):
+        return self.__files
+
+    def is_done(self,filename):
+        return self.__records.get(os.path.abspath(filename),{}).get('state') == 'done'
+
+    def clean_orphans(self):
+        """Removes the temporary files left by files interrupted in the previous batch.
+
+        Incomplete outputs are among them: they are written with the temporary root of their file as
+        prefix, and only renamed to the output name once complete, so an output is never removed.
+        """
+        for filename,record in self.__records.items():
+            if record['state'] in ('done','skipped'):
+                continue
+
+            orphans=[]
+            for tmp_root in record['tmp_roots']:
+                tmp_dir=os.path.dirname(tmp_root) or '.'
+                if os.path.isdir(tmp_dir):
+                    orphans+=[os.path.join(tmp_dir,name) for name in os.listdir(tmp_dir) if name.startswith(os.path.basename(tmp_root))]
+
+            for orphan in orphans:
+                if os.path.isfile(orphan):
+                    print(_("Removing temporary file '{}'.").format(orphan))
+                    os.remove(orphan)
+
+    def record(self,filename,state,**details):
+        record=dict(details,time=round(time.time(),3),file=os.path.abspath(filename),state=state)
+        for key in ('tmp_root','output'):
+            if record.get(key):
+                record[key]=os.path.abspath(record[key]) # The batch may be resumed from another directory.
+
+        line=(json.dumps(record)+'\n').encode('utf-8')
+        with self.__lock:
+            fd=os.open(self.__filename,os.O_WRONLY|os.O_APPEND|os.O_CREAT,0o644)
+            try:
+                os.write(fd,line)
+                os.fsync(fd)
+
+            finally:
+                os.close(fd)
+
 class Reporter:
     """Holds information about the transcoding process and elaborate a final report.
     
@@ -298,16 +1451,73 @@ class Reporter:
         self.__files_ok_counter=0
         self.__files_with_error=[]
         self.__ignored_files=[]
+        self.__skipped_files=[] # (filename, reason) tuples.
+        self.__records=[] # Video.get_report() of each file, with its final state.
+        self.__lock=threading.Lock() # Several transcoding jobs may report at the same time.
         
     def count_file_ok(self):
-        self.__files_ok_counter+=1
+        with self.__lock:
+            self.__files_ok_counter+=1
         
     def add_file_with_errors(self,filename):
-        self.__files_with_error.append(filename)
+        with self.__lock:
+            self.__files_with_error.append(filename)
         
     def add_ignored_file(self,filename):
-        self.__ignored_files.append(filename)
+        with self.__lock:
+            self.__ignored_files.append(filename)
+
+    def add_skipped_file(self,filename,reason):
+        with self.__lock:
+            self.__skipped_files.append((filename,reason))
         
+    def add_file_record(self,record,state):
+        with self.__lock:
+            self.__records.append(dict(record,state=state))
+
+    def get_stage_totals(self):
+        """Returns the figures of each stage added up for all the files.
+        
+        """
+        totals={}
+        with self.__lock:
+            for record in self.__records:
+                for name,stage in record['stages'].items():
+                    total=totals.setdefault(name,{'wall': 0, 'cpu': 0, 'read': 0, 'written': 0})
+                    for key,value in stage.items():
+                        total[key]+=value
+
+        return totals
+
+    def write_report(self,filename,elapsed=None):
+        """Writes the record of every file as CSV (one row per file), or as JSON if filename ends in '.json'.
+        
+        """
+        with self.__lock:
+            records=list(self.__records)
+
+        with open(filename,'w',newline='') as report_file:
+            if filename.lower().endswith('.json'):
+                json.dump({'files': records, 'stages': self.get_stage_totals(), 'counts': self.get_counts(), 'elapsed': elapsed},report_file,indent=2)
+
+            else:
+                stage_names=[name for name in ('probe','subtitles','crop','encode','mux') if any(name in record['stages'] for record in records)]
+                fieldnames=['file','state','output','duration','input_size','output_size','ratio']
+                fieldnames+=['{}_{}'.format(name,key) for name in stage_names for key in ('wall','cpu','read','written')]
+                import csv
+                writer=csv.DictWriter(report_file,fieldnames=fieldnames,extrasaction='ignore')
+                writer.writeheader()
+                for record in records:
+                    row=dict(record)
+                    for name,stage in record['stages'].items():
+                        row.update(('{}_{}'.format(name,key),value) for key,value in stage.items())
+
+                    writer.writerow(row)
+
+    def get_counts(self):
+        with self.__lock:
+            return {'ok': self.__files_ok_counter, 'errors': len(self.__files_with_error), 'ignored': len(self.__ignored_files), 'skipped': len(self.__skipped_files)}
+
     def print_final_report(self):
         """Print report after all transcoding is made.
         """
@@ -319,6 +1529,14 @@ class Reporter:
                 
             print(75*'=')
             print('\n')
+
+        if self.__skipped_files:
+            print(_('== The following files were skipped: =='))
+            for filename,reason in self.__skipped_files:
+                print('\t* {} ({})'.format(filename,reason))
+                
+            print(75*'=')
+            print('\n')
             
         if self.__files_with_error:
             print(_('== There were errors transcoding the files: =='))
@@ -346,179 +1564,1971 @@ class Reporter:
             output += _(' files')
             
         output+=_(' with errors.\n')
+        output += '\t {:d}'.format(len(self.__skipped_files))
+        if len(self.__skipped_files) == 1:
+            output += _(' file')
+
+        else:
+            output += _(' files')
+            
+        output+=_(' skipped.\n')
         
         sys.stdout.write(output)
+        with self.__lock:
+            sizes=[(record['input_size'],record['output_size']) for record in self.__records if record['state'] == 'done' and record['input_size'] and record['output_size']]
+
+        if sizes:
+            in_size=sum(size[0] for size in sizes)
+            out_size=sum(size[1] for size in sizes)
+            sys.stdout.write(_('\t {:.1f} MiB transcoded to {:.1f} MiB ({:.0%}).\n').format(in_size/2**20,out_size/2**20,out_size/in_size))
+
+        totals=self.get_stage_totals()
+        if totals:
+            print(_('== Time by stage (wall, child processes CPU, MiB read, MiB written): =='))
+            for name,stage in totals.items():
+                print('\t{:10} {:>10} {:>10} {:>10.1f} {:>10.1f}'.format(name,format_eta(stage['wall']),format_eta(stage['cpu']),stage['read']/2**20,stage['written']/2**20))
             
         print(75*'=')
         print('\n')
 
-## Functions
-def check_the_required_programs():
-    if os.system("ffmpeg -h > /dev/null 2>&1"):
-        sys.stderr.write(_("ERROR: ffmpeg is not installed in your system.\nThis script can not work properly without it.\n\n"))
-        exit()
-        
-    if os.system("mkvmerge -h > /dev/null"):
-        sys.stderr.write(_("ERROR: mkvtoolnix is not installed in your system.\nThis script can not work properly without it.\n\n"))
-        exit()
-        
-def print_duration(seconds):
-    output=''
-    seconds_per_minute=60
-    seconds_per_hour=60*seconds_per_minute
-    seconds_per_day=24*seconds_per_hour
-    
-    days=int(seconds/seconds_per_day)
-    hours=int((seconds % seconds_per_day)/seconds_per_hour)
-    minutes=int((seconds % seconds_per_hour)/seconds_per_minute)
-    seconds=seconds%60
+class Progress:
+    """Progress of the ffmpeg processes transcoding one file, fed with the output of ffmpeg -progress.
     
-    if days:
-        #output+=('%d' % (days))
-        output+=('{:d}'.format(days))
-        if days==1:
-            output+=_(' day ')
-            
-        else:
-            output+=_(' days ')
-            
-    if hours:
-        #output+=('%2d' % (hours))
-        output+=('{:2d}'.format(hours))
-        if hours==1:
-            output+=_(' hour ')
-            
-        else:
-            output+=_(' hours ')
-            
-    if minutes:
-        #output+=('%2d' % (minutes))
-        output+=('{:2d}'.format(minutes))
-        if minutes==1:
-            output+=_(' minute ')
-            
-        else:
-            output+=_(' minutes ')
-            
-    if seconds:
-        #output+=('%4.2f' % (seconds))
-        output+=('{:4.2f}'.format(seconds))
-        if seconds==1:
-            output+=_(' second ')
-            
-        else:
-            output+=_(' seconds ')
-                
-    return output.strip()
+    """
+    def __init__(self,filename,duration,telemetry):
+        self.__filename=filename
+        self.__duration=duration
+        self.__telemetry=telemetry
+        self.__processes={} # Latest values reported by each ffmpeg process (more than one with --chunks).
+        self.__start_time=time.time()
+        self.__last_report=0
 
-    
-def ass2srt(in_filename):
-    out_filename=os.path.splitext(in_filename)[0]+'.srt'
-    in_file=open(in_filename,'r')
-    out_file=open(out_filename,'w')
-    dialog_counter=0
-    for line in in_file:
-        dialog=''
-        line=line.strip()
-        if line[:9] == 'Dialogue:':
-            dialog_counter+=1
-            fields=line[10:].split(',')
-            ftime=line[10:].split(',')[1]
-            ltime=line[10:].split(',')[2]
-            for sentence in fields[3:]:
-                dialog+=(sentence+',')
-                
-            dialog=dialog.rstrip(',')
-            ftime_hour,ftime_min,ftime_seconds=ftime.split(':')
-            ftime_hour,ftime_min=int(ftime_hour),int(ftime_min)
-            ftime_seconds,ftime_mseconds=ftime_seconds.split('.')
-            ftime_seconds,ftime_mseconds=int(ftime_seconds),int(ftime_mseconds)*10
-
-            ltime_hour,ltime_min,ltime_seconds=ltime.split(':')
-            ltime_hour,ltime_min=int(ltime_hour),int(ltime_min)
-            ltime_seconds,ltime_mseconds=ltime_seconds.split('.')
-            ltime_seconds,ltime_mseconds=int(ltime_seconds),int(ltime_mseconds)*10
-            
-            output_line="{:d}\n{:02d}:{:02d}:{:02d},{:03d} --> {:02d}:{:02d}:{:02d},{:03d}\n{}\n\n".format(dialog_counter,ftime_hour,ftime_min,ftime_seconds,ftime_mseconds,ltime_hour,ltime_min,ltime_seconds,ltime_mseconds,dialog)
-            out_file.write(output_line)
-            
-    
-    in_file.close()
-    out_file.close()
-    
-    return out_filename
+    def update(self,key,values):
+        """Stores the values of an ffmpeg -progress block reported by the process identified by key.
+        
+        """
+        out_time=parse_number(values.get('out_time_us') or values.get('out_time_ms'),int) # Both are microseconds.
+        self.__processes[key]={
+            'out_time': max(out_time,0)/1e6 if out_time is not None else 0,
+            'fps': parse_number(values.get('fps'),float) or 0,
+            'speed': parse_number(values.get('speed','').rstrip('x'),float) or 0,
+            'bitrate': parse_number(values.get('bitrate','').replace('kbits/s',''),float),
+            'running': values.get('progress') != 'end',
+        }
+        now=time.time()
+        if now-self.__last_report >= 1 or values.get('progress') == 'end':
+            self.__last_report=now
+            self.__telemetry.report(self)
 
-def dstring2dint(duration_string):
-    hours,minutes,seconds=duration_string.split(':')
-    hours,minutes,seconds=int(hours),int(minutes),int(round(float(seconds)))
-    duration_seconds=3600*hours+60*minutes+seconds
-    return duration_seconds
+    def finish(self,ok):
+        self.__telemetry.finish_file(self,ok)
 
-def random_string(length = 10):
-    rand_string = ''
-    for letter in random.sample(string.ascii_lowercase + string.ascii_uppercase + string.digits, length):
-        rand_string += letter
+    def get_filename(self):
+        return self.__filename
 
-    return rand_string
+    def get_duration(self):
+        return self.__duration or 0
 
-def run_script():
-    """Function to be called to actually run the script.
-    """
-    check_the_required_programs()
-    initial_time=time.time()
-    parser=argparse.ArgumentParser(description=_("This program transcode video files to H265 and AAC in MKV format. Subtitles, if present, are automatically detected and soft subbed into the corresponding output files."), add_help=False)
-    parser.add_argument('video', nargs='+', help=_('Input video file(s).'))
-    parser.add_argument('-h','--help', action='help', help=_("Show this help message and exit."))
-    parser.add_argument('-p', '--preset', default='medium', help=_('X265 preset [default: %(default)s].'))
-    parser.add_argument('-q','--crf', type=int, default=28, help=_('CRF value [default: %(default)s]. Determines the output video quality. Smaller values gives better qualities and bigger file sizes, bigger values result in less quality and smaller file sizes. Default value results in a nice quality/size ratio. CRF values should be in the range of 1 to 50.'))
-    parser.add_argument('-r', '--replace-original-video-file', action='store_true', default=False, dest='replace', help=_('If set then original video files will be erased after transcoding. WARNING: deleted files can not be easily recovered!'))
-    parser.add_argument('-l','--avlang', default='eng', help=_('Default audio language for MKV files obtained (used only if the original stream languages fail to be determined) [default: %(default)s].'))
-    parser.add_argument('-L', '--slang', default='spa', help=_('Default subtitle language of soft-subbed subtitles (only used if original subtitle languages fail to be determined) [default: %(default)s].'))
-    parser.add_argument('-x', '--filename-postfix', default='_h265', help=_('Postfix to be added to newly created H.265 video files [default: %(default)s].'))
-    parser.add_argument('-t', '--threads', type=int, default=0, help=_('Indicates the number of processor cores the script will use. 0 indicates to use as many as possible [default: %(default)s].'))
-    parser.add_argument('-c', '--auto-crop', action='store_true', default=False, help=_('Turn on autocrop function. WARNING: Use with caution as some video files has variable width horizontal (and vertical) black bars, in those cases you will probably lose data.')) 
-    parser.add_argument('-v', '--version', action='version', version='3.2.7', help=_("Show program's version number and exit.")) # I need to use this explicit help message here (together with setting add_help=False when creating the parser) to be able to proper translate the version help message (when required). All other messages are translated OK, but not this one. With this edit now everything is OK.
-    
-    args=parser.parse_args()
+    def get_out_time(self):
+        """Returns the seconds of video already transcoded.
+        
+        """
+        return sum(process['out_time'] for process in self.__processes.values())
 
-    if args.crf < 1 or args.crf > 50:
-        parser.error(_('CRF values should be in the range of 1 to 50.'))
+    def get_fps(self):
+        return sum(process['fps'] for process in self.__processes.values() if process['running'])
+
+    def get_speed(self):
+        """Returns the transcoded video seconds per wall clock second.
         
-    if args.threads < 0:
-        parser.error(_('The number of threads must be 0 or positive.'))
+        """
+        return sum(process['speed'] for process in self.__processes.values() if process['running'])
 
-    known_presets = ["ultrafast", "superfast", "veryfast", "faster", "fast", "medium", "slow", "slower", "veryslow"]
-    if args.preset not in known_presets:
-        parser.error(_('Unknown preset "{}".\nValid values are:\n\t{}\n').format(args.preset, '\n\t'.join(known_presets)))
+    def get_bitrate(self):
+        bitrates=[process['bitrate'] for process in self.__processes.values() if process['bitrate']]
+        if not bitrates:
+            return None
 
-    reporter=Reporter()
-    file_counter=0
-    for filename in args.video:
-        file_counter+=1        
-        print(_('\n==== Transcoding file {:d}/{:d} ====').format(file_counter,len(args.video)))
-        video=Video(filename)
-        if not video.is_ok():
-            sys.stderr.write(_("File {} is not a proper video file.\n").format(filename))
-            reporter.add_ignored_file(filename)
-            continue
+        return sum(bitrates)/len(bitrates)
+
+    def get_elapsed_time(self):
+        return time.time()-self.__start_time
+
+    def get_eta(self):
+        speed=self.get_speed()
+        if not self.__duration or not speed:
+            return None
+
+        return max(self.__duration-self.get_out_time(),0)/speed
+
+    def get_status(self):
+        """Returns the progress as a dictionary ready to be dumped as JSON.
         
-        video.set_transcoding_options(args.preset, args.crf, args.replace, args.avlang, args.slang, args.filename_postfix, args.threads, args.auto_crop)
-        if video.transcode():
-            reporter.count_file_ok()
-            #video.clean()
-            
-        else:
-            reporter.add_file_with_errors(filename)
+        """
+        return {
+            'file': self.__filename,
+            'duration': self.__duration,
+            'out_time': round(self.get_out_time(),3),
+            'ratio': round(min(self.get_out_time()/self.__duration,1),4) if self.__duration else None,
+            'fps': round(self.get_fps(),2),
+            'speed': round(self.get_speed(),3),
+            'bitrate_kbps': self.get_bitrate(),
+            'elapsed': round(self.get_elapsed_time(),1),
+            'eta': round(self.get_eta(),1) if self.get_eta() is not None else None,
+        }
 
-        video.clean() # Always clean, not only in success, please...
-            
-        print(75*'=')
-            
-    reporter.print_final_report()
+class Telemetry:
+    """Collects the progress of all the files of the batch, and publishes it.
+
+    The status can be shown in the terminal, appended as JSON lines to a log file and written
+    as a Prometheus textfile (for the node_exporter textfile collector).
+    """
+    def __init__(self,total_duration,console=True,log_filename=None,prometheus_filename=None,callback=None):
+        self.__total_duration=total_duration
+        self.__callback=callback # Called with the event, file status and batch status of every report.
+        self.__done_duration=0
+        self.__console=console
+        self.__log_filename=log_filename
+        self.__prometheus_filename=prometheus_filename
+        self.__running=[]
+        self.__files_done=0
+        self.__files_failed=0
+        self.__lock=threading.Lock()
+
+    def add_duration(self,duration):
+        """Adds the duration of a file queued after the batch started.
         
-    final_time=time.time()
-    
-    print(_('Work finished in {}.').format(print_duration(final_time-initial_time)))
+        """
+        with self.__lock:
+            self.__total_duration+=duration
+
+    def start_file(self,filename,duration):
+        progress=Progress(filename,duration,self)
+        with self.__lock:
+            self.__running.append(progress)
+
+        return progress
+
+    def finish_file(self,progress,ok):
+        with self.__lock:
+            self.__running.remove(progress)
+            self.__done_duration+=progress.get_duration()
+            if ok:
+                self.__files_done+=1
+
+            else:
+                self.__files_failed+=1
+
+        self.report(progress,'end' if ok else 'failed')
+        if self.__console:
+            sys.stdout.write('\n')
+
+    def get_batch_status(self):
+        with self.__lock:
+            running=list(self.__running)
+            done_duration=self.__done_duration
+
+        transcoded=done_duration+sum(min(progress.get_out_time(),progress.get_duration()) for progress in running)
+        speed=sum(progress.get_speed() for progress in running)
+        eta=None
+        if speed:
+            eta=round(max(self.__total_duration-transcoded,0)/speed,1)
+
+        return {
+            'files_running': len(running),
+            'files_done': self.__files_done,
+            'files_failed': self.__files_failed,
+            'ratio': round(min(transcoded/self.__total_duration,1),4) if self.__total_duration else None,
+            'eta': eta,
+        }
+
+    def report(self,progress,event='progress'):
+        status=progress.get_status()
+        batch_status=self.get_batch_status()
+        if self.__console and event == 'progress':
+            sys.stdout.write(_('\r{:.0f}/{:.0f} s, {:.1f} fps, {:.2f}x, {} kbits/s, ETA {}, batch ETA {}   ').format(status['out_time'],status['duration'] or 0,status['fps'],status['speed'],status['bitrate_kbps'] or '-',format_eta(status['eta']),format_eta(batch_status['eta'])))
+            sys.stdout.flush()
+
+        if self.__log_filename:
+            record=dict(status,time=round(time.time(),3),event=event,batch=batch_status)
+            with self.__lock, open(self.__log_filename,'a') as log_file:
+                log_file.write(json.dumps(record)+'\n')
+
+        if self.__prometheus_filename:
+            self.__write_prometheus_file(batch_status)
+
+        if self.__callback:
+            self.__callback(event,status,batch_status)
+
+    def __write_prometheus_file(self,batch_status):
+        with self.__lock:
+            running=list(self.__running)
+
+        lines=[]
+        statuses=[progress.get_status() for progress in running]
+        for metric,key in [('progress_ratio','ratio'),('fps','fps'),('speed','speed'),('bitrate_kbps','bitrate_kbps'),('eta_seconds','eta')]:
+            lines.append('# TYPE transcode2h265_file_{} gauge'.format(metric))
+            for status in statuses:
+                if status[key] is not None:
+                    lines.append('transcode2h265_file_{}{{file="{}"}} {}'.format(metric,prometheus_label(status['file']),status[key]))
+
+        for metric,key in [('files_running','files_running'),('files_done','files_done'),('files_failed','files_failed'),('progress_ratio','ratio'),('eta_seconds','eta')]:
+            lines.append('# TYPE transcode2h265_batch_{} gauge'.format(metric))
+            if batch_status[key] is not None:
+                lines.append('transcode2h265_batch_{} {}'.format(metric,batch_status[key]))
+
+        lines+=['# TYPE transcode2h265_last_update_timestamp_seconds gauge', 'transcode2h265_last_update_timestamp_seconds {:.3f}'.format(time.time())]
+        tmp_filename=self.__prometheus_filename+'.tmp'
+        with self.__lock:
+            with open(tmp_filename,'w') as prometheus_file:
+                prometheus_file.write('\n'.join(lines)+'\n')
+
+            os.replace(tmp_filename,self.__prometheus_filename) # Collectors must never read a half written file.
+
+class Scheduler:
+    """Runs several transcoding jobs at the same time, sharing the processor cores among them.
+    
+    """
+    def __init__(self,jobs,threads,reporter):
+        self.__jobs=jobs
+        self.__threads=threads # 0 means as many as possible.
+        self.__reporter=reporter
+        self.__videos=[]
+        self.__pending=0
+        self.__running=0
+        self.__lock=threading.Lock()
+        self.__executor=None
+        self.__job_function=None
+
+    def add_video(self,video):
+        self.__videos.append(video)
+
+    def get_videos(self):
+        return self.__videos
+
+    def get_total_duration(self):
+        return sum(video.get_duration() for video in self.__videos)
+
+    def __threads_for_new_job(self):
+        # Called with the lock held. The thread budget is split among the jobs that will be
+        # running together, so the last jobs of the queue get more cores each.
+        if self.__jobs == 1:
+            return self.__threads
+
+        budget=self.__threads or os.cpu_count() or 1
+        active_jobs=min(self.__jobs,self.__pending+self.__running)
+        return max(1,budget//active_jobs)
+
+    def __run_job(self,video,job_function):
+        with self.__lock:
+            threads=self.__threads_for_new_job()
+            self.__pending-=1
+            self.__running+=1
+
+        try:
+            job_function(video,threads,self.__jobs > 1)
+
+        except Exception as error:
+            sys.stderr.write(_("ERROR: Unexpected failure transcoding {}: {}\n").format(video.get_filename(),error))
+            self.__reporter.add_file_with_errors(video.get_filename())
+
+        finally:
+            with self.__lock:
+                self.__running-=1
+
+    def run(self,job_function):
+        """Calls job_function(video, threads, quiet) for every queued video.
+        
+        """
+        videos=self.__videos
+        if self.__jobs > 1:
+            videos=sorted(videos,key=lambda video: video.get_duration(),reverse=True) # Longest first, to shorten the total run.
+
+        self.__pending=len(videos)
+        if self.__jobs == 1:
+            for video in videos:
+                self.__run_job(video,job_function)
+
+            return
+
+        import concurrent.futures
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.__jobs) as executor:
+            futures=[executor.submit(self.__run_job,video,job_function) for video in videos]
+            try:
+                concurrent.futures.wait(futures)
+
+            except KeyboardInterrupt:
+                for future in futures:
+                    future.cancel() # The running ones end soon, as their processes were killed.
+
+                raise
+
+    def start(self,job_function):
+        """Starts transcoding the queued videos, and accepting more with submit() while they are transcoded.
+        
+        """
+        self.__job_function=job_function
+        import concurrent.futures
+        self.__executor=concurrent.futures.ThreadPoolExecutor(max_workers=self.__jobs)
+        for video in sorted(self.__videos,key=lambda video: video.get_duration(),reverse=True):
+            self.__submit(video)
+
+    def submit(self,video):
+        self.__videos.append(video)
+        self.__submit(video)
+
+    def __submit(self,video):
+        with self.__lock:
+            self.__pending+=1
+
+        self.__executor.submit(self.__run_job,video,self.__job_function)
+
+    def stop(self,cancel=False):
+        """Waits for the submitted videos to be transcoded, or only for the running ones if cancel is True.
+        
+        """
+        self.__executor.shutdown(wait=True,cancel_futures=cancel)
+
+    def get_status(self):
+        with self.__lock:
+            return {'queued': self.__pending, 'running': self.__running}
+
+class DirectoryWatcher:
+    """Tells which files of some directories may have changed, using inotify or, if not available, polling.
+    
+    """
+    def __init__(self,directories,poll_interval=10):
+        self.__directories=directories
+        self.__poll_interval=poll_interval
+        self.__inotify_fd=None
+        self.__watches={} # Watched directory of each inotify watch descriptor.
+        self.__first_call=True
+        self.__init_inotify()
+
+    def __init_inotify(self):
+        in_modify,in_close_write,in_moved_to,in_create=0x2,0x8,0x80,0x100
+        try:
+            import ctypes
+            import ctypes.util
+            libc=ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',use_errno=True)
+            fd=libc.inotify_init1(os.O_NONBLOCK|os.O_CLOEXEC)
+
+        except (OSError,AttributeError):
+            return
+
+        if fd < 0:
+            return
+
+        for directory in self.__directories:
+            watch=libc.inotify_add_watch(fd,os.fsencode(directory),in_modify|in_close_write|in_moved_to|in_create)
+            if watch < 0:
+                os.close(fd)
+                return
+
+            self.__watches[watch]=directory
+
+        self.__inotify_fd=fd
+
+    def uses_inotify(self):
+        return self.__inotify_fd is not None
+
+    def __list_files(self):
+        filenames=set()
+        for directory in self.__directories:
+            with os.scandir(directory) as entries:
+                filenames.update(entry.path for entry in entries if entry.is_file())
+
+        return filenames
+
+    def wait_for_changes(self,timeout):
+        """Waits up to timeout seconds and returns the set of files that may have changed.
+
+        The first call returns all the files already present in the directories.
+        """
+        if self.__first_call:
+            self.__first_call=False
+            return self.__list_files()
+
+        if not self.uses_inotify():
+            time.sleep(min(timeout,self.__poll_interval))
+            return self.__list_files()
+
+        changed=set()
+        if select.select([self.__inotify_fd],[],[],timeout)[0]:
+            try:
+                data=os.read(self.__inotify_fd,65536)
+
+            except BlockingIOError:
+                return changed
+
+            import struct
+            offset=0
+            while offset+16 <= len(data):
+                watch,mask,cookie,name_length=struct.unpack_from('iIII',data,offset)
+                name=data[offset+16:offset+16+name_length].rstrip(b'\0')
+                offset+=16+name_length
+                if name and watch in self.__watches:
+                    changed.add(os.path.join(self.__watches[watch],os.fsdecode(name)))
+
+        return changed
+
+    def close(self):
+        if self.__inotify_fd is not None:
+            os.close(self.__inotify_fd)
+            self.__inotify_fd=None
+
+class StatusRequestHandler:
+    """Answers any GET request with the JSON status returned by the get_status attribute of the server.
+
+    It is mixed with http.server.BaseHTTPRequestHandler by create_status_server, so http.server is only
+    imported when a status port is given.
+    """
+    def do_GET(self):
+        body=json.dumps(self.server.get_status(),indent=2).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type','application/json')
+        self.send_header('Content-Length',str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self,format,*args):
+        pass # Do not mix requests with the transcoding output.
+
+class Profiler:
+    """Profiles the Python code of the main thread and of the transcoding jobs, that run in their own threads.
+
+    Before Python 3.12 a profile only sees the thread that enabled it, so every job thread gets its own.
+    """
+    def __init__(self):
+        self.__profiles=[]
+        self.__lock=threading.Lock()
+
+    def __new_profile(self):
+        import cProfile
+        profile=cProfile.Profile()
+        with self.__lock:
+            self.__profiles.append(profile)
+
+        return profile
+
+    def enable(self):
+        """Starts profiling the calling thread.
+        
+        """
+        self.__new_profile().enable()
+
+    def wrap(self,function):
+        """Returns function, profiled in whatever thread it is called.
+        
+        """
+        if sys.version_info >= (3,12):
+            return function # The profile of the main thread sees all the threads, and only one can be active.
+
+        return lambda *args,**kwargs: self.__new_profile().runcall(function,*args,**kwargs)
+
+    def save(self,filename):
+        """Writes the statistics of all the profiled threads, to be read with pstats, and its summary if filename ends in '.txt'.
+        
+        """
+        with self.__lock:
+            for profile in self.__profiles:
+                profile.disable()
+
+            import pstats
+            stats=pstats.Stats(*self.__profiles)
+
+        if filename.lower().endswith('.txt'):
+            with open(filename,'w') as stats_file:
+                stats.stream=stats_file
+                stats.sort_stats('cumulative').print_stats(50)
+
+        else:
+            stats.dump_stats(filename)
+
+class Coordinator:
+    """Owns the queue of a distributed batch, leasing its videos to worker processes that connect to it.
+
+    Workers may run in this or in other hosts sharing the storage. A lease expires if the worker
+    does not report for lease_time seconds, and is also lost when the worker disconnects; in both
+    cases the video is queued again, up to max_attempts times. Every lease has its own id, and only
+    the worker holding the current lease of a video may commit its output (put it in place, and
+    remove the original with -r): once committed, the lease does not expire.
+    """
+    def __init__(self,videos,options,reporter,journal=None,lease_time=60,max_attempts=3,log_filename=None):
+        self.__queue=collections.deque({'video': video, 'attempts': 0} for video in videos)
+        self.__options=options
+        self.__reporter=reporter
+        self.__journal=journal
+        self.__lease_time=lease_time
+        self.__max_attempts=max_attempts
+        self.__log_filename=log_filename
+        self.__leases={} # Leased jobs, by job id, that is a new one for every lease.
+        self.__job_counter=0
+        self.__lock=threading.Lock()
+
+    def handle_message(self,message,worker):
+        """Answers a message of a worker. worker is a dictionary describing its connection.
+        
+        """
+        operation=message.get('op')
+        with self.__lock:
+            if operation == 'hello':
+                worker['name']=message.get('worker') or worker['name']
+                print(_('Worker {} connected.').format(worker['name']))
+                return {'ok': True, 'options': self.__options, 'lease_time': self.__lease_time}
+
+            if operation == 'lease':
+                if not self.__queue:
+                    return {'job': None, 'done': not self.__leases}
+
+                job=self.__queue.popleft()
+                job['attempts']+=1
+                self.__job_counter+=1
+                job.update(id=self.__job_counter,worker=worker['name'],expires=time.time()+self.__lease_time,status=None,committed=False)
+                self.__leases[job['id']]=job
+                worker['jobs'].add(job['id'])
+                filename=job['video'].get_filename()
+                print(_('Video {} leased to worker {}.').format(filename,worker['name']))
+                if self.__journal:
+                    self.__journal.record(filename,'encoding',worker=worker['name'])
+
+                return {'job': {'id': job['id'], 'file': os.path.abspath(filename)}}
+
+            job=self.__leases.get(message.get('id'))
+            if not job or job['worker'] != worker['name']:
+                return {'ok': False, 'error': 'lease lost'}
+
+            job['expires']=time.time()+self.__lease_time
+            if operation == 'commit':
+                job['committed']=True # The output is being put in place, it can not be leased again.
+                return {'ok': True}
+
+            if operation in ('heartbeat','progress'):
+                if message.get('status'):
+                    job['status']=message['status']
+                    self.__log(dict(message['status'],event=message.get('event','progress'),worker=worker['name']))
+
+                return {'ok': True}
+
+            if operation == 'result':
+                del self.__leases[job['id']]
+                worker['jobs'].discard(job['id'])
+                self.__finish_job(job,message.get('state'),message)
+                return {'ok': True}
+
+        return {'ok': False, 'error': 'unknown operation'}
+
+    def __finish_job(self,job,state,details):
+        # Called with the lock held.
+        filename=job['video'].get_filename()
+        print(_('Video {} finished by worker {}: {}.').format(filename,job['worker'],state))
+        if state == 'done':
+            self.__reporter.count_file_ok()
+            if self.__journal:
+                self.__journal.record(filename,'done',output=details.get('output'))
+
+        elif state == 'skipped':
+            self.__reporter.add_skipped_file(filename,details.get('reason'))
+            if self.__journal:
+                self.__journal.record(filename,'skipped',reason=details.get('reason'))
+
+        else:
+            self.__reporter.add_file_with_errors(filename)
+            if self.__journal:
+                self.__journal.record(filename,'failed')
+
+        if details.get('record'):
+            self.__reporter.add_file_record(details['record'],state)
+
+        self.__log({'file': filename, 'event': 'result', 'state': state, 'worker': job['worker'], 'elapsed': details.get('elapsed')})
+
+    def __log(self,record):
+        if self.__log_filename:
+            with open(self.__log_filename,'a') as log_file:
+                log_file.write(json.dumps(dict(record,time=round(time.time(),3)))+'\n')
+
+    def __requeue(self,job,reason):
+        # Called with the lock held.
+        filename=job['video'].get_filename()
+        del self.__leases[job['id']]
+        if job['attempts'] >= self.__max_attempts:
+            sys.stderr.write(_("ERROR: Video {} failed {:d} times ({}), giving up.\n").format(filename,job['attempts'],reason))
+            self.__finish_job(job,'failed',{})
+
+        else:
+            sys.stderr.write(_("WARNING: Video {} queued again ({}).\n").format(filename,reason))
+            self.__queue.appendleft(job)
+
+    def release_worker(self,worker):
+        """Queues again the videos leased to a worker that disconnected.
+        
+        """
+        with self.__lock:
+            for job_id in list(worker['jobs']):
+                if job_id in self.__leases:
+                    self.__requeue(self.__leases[job_id],_('worker {} disconnected').format(worker['name']))
+
+    def get_status(self):
+        with self.__lock:
+            return {'queued': len(self.__queue), 'leased': [{'file': job['video'].get_filename(), 'worker': job['worker'], 'status': job['status']} for job in self.__leases.values()], 'files': self.__reporter.get_counts()}
+
+    def run(self,address):
+        """Serves the workers until every video is finished.
+        
+        """
+        server=create_coordinator_server(address)
+        server.coordinator=self
+        threading.Thread(target=server.serve_forever,daemon=True).start()
+        print(_('Coordinator listening at {}. Start workers with --worker {}.').format(address,address))
+        try:
+            while True:
+                time.sleep(1)
+                with self.__lock:
+                    for job in [job for job in self.__leases.values() if job['expires'] < time.time() and not job['committed']]:
+                        self.__requeue(job,_('lease of worker {} expired').format(job['worker']))
+
+                    if not self.__queue and not self.__leases:
+                        break
+
+            time.sleep(2) # Let idle workers, that ask every second, learn that the batch is done.
+
+        finally:
+            server.shutdown()
+            server.server_close()
+            if isinstance(address,str) and not is_tcp_address(address) and os.path.exists(address):
+                os.remove(address)
+
+class CoordinatorRequestHandler:
+    """Reads JSON messages from a worker, one per line, and writes one JSON answer line for each.
+
+    It is mixed with socketserver.StreamRequestHandler by create_coordinator_server, so socketserver is
+    only imported by the coordinator.
+    """
+    def handle(self):
+        worker={'name': str(self.client_address or 'unix socket'), 'jobs': set()}
+        try:
+            for line in self.rfile:
+                try:
+                    message=json.loads(line)
+
+                except ValueError:
+                    break
+
+                response=self.server.coordinator.handle_message(message,worker)
+                self.wfile.write((json.dumps(response)+'\n').encode('utf-8'))
+
+        except OSError:
+            pass
+
+        finally:
+            self.server.coordinator.release_worker(worker)
+
+class Benchmark:
+    """Encodes short clips with a grid of x265 presets, CRF values and thread counts, and measures them.
+
+    Clips are taken from the middle of each input video, or generated with the testsrc2 source of
+    ffmpeg when there are no inputs. For every combination the speed (fps), the processor time,
+    the output bit rate and, if requested and supported by ffmpeg, the SSIM and VMAF are recorded.
+    """
+    def __init__(self,presets,crfs,threads,clip_duration=10,quality=False):
+        self.__presets=presets
+        self.__crfs=crfs
+        self.__threads=threads
+        self.__clip_duration=clip_duration
+        self.__quality_filters=[]
+        self.__results=[]
+        if quality:
+            self.__quality_filters=[name for name in ('ssim','libvmaf') if ffmpeg_has_filter(name)]
+
+    def run(self,videos):
+        import tempfile
+        with tempfile.TemporaryDirectory(prefix='transcode2H265_benchmark_') as tmp_dir:
+            sources=[(video.get_filename(),video.get_duration()) for video in videos] or [('testsrc2',None)]
+            for source,duration in sources:
+                reference=os.path.join(tmp_dir,'reference.mkv')
+                if not self.__make_reference_clip(source,duration,reference):
+                    sys.stderr.write(_("ERROR: A benchmark clip could not be taken from {}.\n").format(source))
+                    continue
+
+                frames=count_frames(reference)
+                for preset in self.__presets:
+                    for crf in self.__crfs:
+                        for threads in self.__threads:
+                            self.__results.append(self.__encode(source,reference,frames,preset,crf,threads,os.path.join(tmp_dir,'output.mkv')))
+                            self.__print_result(self.__results[-1])
+
+        return self.__results
+
+    def __make_reference_clip(self,source,duration,reference):
+        if duration is None:
+            cmd=['ffmpeg', '-nostdin', '-loglevel', 'error', '-f', 'lavfi', '-i', 'testsrc2=size=1920x1080:rate=24', '-t', str(self.__clip_duration), '-c:v', 'libx264', '-preset', 'ultrafast', '-qp', '0', '-y', reference]
+
+        else:
+            start=max(duration/2-self.__clip_duration/2,0)
+            cmd=['ffmpeg', '-nostdin', '-loglevel', 'error', '-ss', '{:.3f}'.format(start), '-i', source, '-t', str(self.__clip_duration), '-map', '0:v:0', '-c', 'copy', '-y', reference]
+
+        return not run_ffmpeg(cmd)
+
+    def __encode(self,source,reference,frames,preset,crf,threads,output):
+        cmd=['ffmpeg', '-nostdin', '-loglevel', 'error', '-i', reference, '-map', '0:v:0', '-c:v', 'libx265', '-preset', preset, '-crf', str(crf), '-x265-params', 'log-level=error', '-threads', str(threads), '-y', output]
+        children_usage=resource.getrusage(resource.RUSAGE_CHILDREN)
+        start_time=time.time()
+        exit_code=run_ffmpeg(cmd)
+        wall_time=time.time()-start_time
+        new_children_usage=resource.getrusage(resource.RUSAGE_CHILDREN)
+        cpu_time=(new_children_usage.ru_utime-children_usage.ru_utime)+(new_children_usage.ru_stime-children_usage.ru_stime)
+        result={'source': source, 'preset': preset, 'crf': crf, 'threads': threads, 'frames': frames, 'ok': not exit_code,
+                'wall_seconds': round(wall_time,3), 'fps': round(frames/wall_time,2) if frames else None,
+                'cpu_seconds': round(cpu_time,3), 'bitrate_kbps': None, 'ssim': None, 'vmaf': None}
+        if not exit_code:
+            output_info=probe_media(output)
+            if output_info and output_info.get_duration():
+                result['bitrate_kbps']=round(os.path.getsize(output)*8/output_info.get_duration()/1000,1)
+
+            for filter_name in self.__quality_filters:
+                result['vmaf' if filter_name == 'libvmaf' else 'ssim']=measure_quality(output,reference,filter_name)
+
+        return result
+
+    def __print_result(self,result):
+        print(_('{source}: preset {preset}, CRF {crf}, {threads} threads: {fps} fps, {cpu_seconds} s CPU, {bitrate_kbps} kbits/s, SSIM {ssim}, VMAF {vmaf}').format(**result))
+
+    def write_report(self,filename):
+        """Writes the results as CSV, or as JSON if filename ends in '.json'.
+        
+        """
+        with open(filename,'w',newline='') as report_file:
+            if filename.lower().endswith('.json'):
+                json.dump(self.__results,report_file,indent=2)
+
+            else:
+                import csv
+                writer=csv.DictWriter(report_file,fieldnames=['source','preset','crf','threads','ok','frames','wall_seconds','fps','cpu_seconds','bitrate_kbps','ssim','vmaf'])
+                writer.writeheader()
+                writer.writerows(self.__results)
+
+## Functions
+def check_the_required_programs(use_cache=True):
+    """Finds ffmpeg, ffprobe, mkvmerge and mkvextract in the PATH, and exits if any of them is missing or does not work.
+
+    Each program found is run once to get its version, that is kept in the cache directory with its size
+    and modification time, so it is not run again until it changes.
+    """
+    mkvtoolnix_message=_("ERROR: mkvtoolnix is not installed in your system.\nThis script can not work properly without it.\n\n")
+    required=[('ffmpeg','-version',_("ERROR: ffmpeg is not installed in your system.\nThis script can not work properly without it.\n\n")),
+              ('ffprobe','-version',_("ERROR: ffprobe is not installed in your system (it is usually installed together with ffmpeg).\nThis script can not work properly without it.\n\n")),
+              ('mkvmerge','--version',mkvtoolnix_message),
+              ('mkvextract','--version',mkvtoolnix_message)]
+    cache_filename=os.path.join(default_cache_dir(),'programs.json')
+    known={} # path: {'identity': [size, mtime_ns], 'version': first line of its version}
+    if use_cache:
+        try:
+            with open(cache_filename) as cache_file:
+                known=json.load(cache_file)
+
+        except (OSError,ValueError):
+            pass
+
+    programs={}
+    changed=False
+    for name,version_option,message in required:
+        path=shutil.which(name)
+        entry=None
+        if path:
+            stat=os.stat(path)
+            entry=known.get(path)
+            if not entry or entry.get('identity') != [stat.st_size,stat.st_mtime_ns]:
+                result=process_runner.run([path,version_option],process_runner.get_probe_timeout(),subprocess.PIPE,subprocess.DEVNULL)
+                entry=None
+                if result.returncode == 0:
+                    entry={'identity': [stat.st_size,stat.st_mtime_ns], 'version': (result.stdout.splitlines() or [''])[0].strip()}
+                    known[path]=entry
+                    changed=True
+
+        if not entry:
+            sys.stderr.write(message)
+            exit()
+
+        programs[name]=path
+
+    if use_cache and changed:
+        try:
+            os.makedirs(os.path.dirname(cache_filename),exist_ok=True)
+            with open(cache_filename+'.tmp','w') as cache_file:
+                json.dump(known,cache_file,indent=2)
+
+            os.replace(cache_filename+'.tmp',cache_filename) # Other instances may be reading it.
+
+        except OSError:
+            pass
+
+    process_runner.set_programs(programs)
+
+def detect_charset(filename):
+    """Returns the charset of a text file as a name known by Python, mkvmerge and iconv, 'binary' for non text files, or None if it can not be read.
+
+    Byte order marks are trusted, then ASCII and UTF-8 are tried, and Windows-1252 (or ISO-8859-1 if it
+    does not fit) is assumed otherwise, as it is the usual charset of old subtitles.
+    """
+    try:
+        with open(filename,'rb') as in_file:
+            data=in_file.read()
+
+    except OSError:
+        return None
+
+    if data.startswith(b'\xef\xbb\xbf'):
+        return 'utf-8'
+
+    if data.startswith((b'\xff\xfe\x00\x00',b'\x00\x00\xfe\xff')):
+        return 'utf-32'
+
+    if data.startswith((b'\xff\xfe',b'\xfe\xff')):
+        return 'utf-16'
+
+    if b'\x00' in data:
+        return 'binary'
+
+    for charset in ('us-ascii','utf-8','windows-1252'):
+        try:
+            data.decode(charset)
+            return charset
+
+        except UnicodeDecodeError:
+            pass
+
+    return 'iso-8859-1' # Any byte sequence is valid ISO-8859-1.
+
+def move_file(source,destination,tmp_filename):
+    """Moves source to destination, that appears complete or not at all.
+
+    Within a filesystem the file is just renamed. Otherwise it is copied to tmp_filename, that must be
+    in the directory of destination, flushed to disk, and then renamed.
+    """
+    try:
+        os.rename(source,destination)
+        return
+
+    except OSError as error:
+        if error.errno != errno.EXDEV:
+            raise
+
+    try:
+        with open(source,'rb') as in_file, open(tmp_filename,'wb') as out_file:
+            shutil.copyfileobj(in_file,out_file,16*2**20)
+            out_file.flush()
+            os.fsync(out_file.fileno())
+
+        os.replace(tmp_filename,destination)
+
+    except OSError:
+        if os.path.isfile(tmp_filename):
+            os.remove(tmp_filename)
+
+        raise
+
+    directory_fd=os.open(os.path.dirname(destination) or '.',os.O_RDONLY)
+    try:
+        os.fsync(directory_fd) # So the rename survives a crash too.
+
+    finally:
+        os.close(directory_fd)
+
+    os.remove(source)
+
+def children_cpu_time():
+    usage=resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime+usage.ru_stime
+
+def read_io_counters(pid='self',default=(0,0)):
+    """Returns the bytes read and written by a process (this one by default) and its finished children, or default where /proc is not available.
+    """
+    counters={}
+    try:
+        with open('/proc/{}/io'.format(pid)) as io_file:
+            for line in io_file:
+                key,separator,value=line.partition(':')
+                counters[key]=int(value)
+
+    except (OSError,ValueError):
+        return default
+
+    return counters.get('rchar',0),counters.get('wchar',0)
+
+def print_duration(seconds):
+    output=''
+    seconds_per_minute=60
+    seconds_per_hour=60*seconds_per_minute
+    seconds_per_day=24*seconds_per_hour
+    
+    days=int(seconds/seconds_per_day)
+    hours=int((seconds % seconds_per_day)/seconds_per_hour)
+    minutes=int((seconds % seconds_per_hour)/seconds_per_minute)
+    seconds=seconds%60
+    
+    if days:
+        #output+=('%d' % (days))
+        output+=('{:d}'.format(days))
+        if days==1:
+            output+=_(' day ')
+            
+        else:
+            output+=_(' days ')
+            
+    if hours:
+        #output+=('%2d' % (hours))
+        output+=('{:2d}'.format(hours))
+        if hours==1:
+            output+=_(' hour ')
+            
+        else:
+            output+=_(' hours ')
+            
+    if minutes:
+        #output+=('%2d' % (minutes))
+        output+=('{:2d}'.format(minutes))
+        if minutes==1:
+            output+=_(' minute ')
+            
+        else:
+            output+=_(' minutes ')
+            
+    if seconds:
+        #output+=('%4.2f' % (seconds))
+        output+=('{:4.2f}'.format(seconds))
+        if seconds==1:
+            output+=_(' second ')
+            
+        else:
+            output+=_(' seconds ')
+                
+    return output.strip()
+
+    
+VIDEO_EXTENSIONS=['mkv', 'mp4', 'm4v', 'avi', 'mov', 'wmv', 'asf', 'flv', 'webm', 'mpg', 'mpeg', 'vob', 'ts', 'm2ts', 'mts', 'ogv', '3gp', 'rm', 'rmvb', 'divx'] # Taken from input directories without probing other files.
+ASS_DEFAULT_FORMAT=['layer', 'start', 'end', 'style', 'name', 'marginl', 'marginr', 'marginv', 'effect', 'text'] # Events format of ASS (v4+) files without a Format line.
+ASS_TIME_RE=re.compile(r'(\d+):(\d+):(\d+)(?:[.,](\d+))?')
+ASS_TAG_RE=re.compile(r'\{[^}]*\}')
+ASS_DRAWING_RE=re.compile(r'\{[^}]*\\p[1-9]')
+
+def parse_ass_time(text):
+    """Returns an ASS time (H:MM:SS.CC, with any number of digits in each field) in milliseconds, or None.
+    """
+    match=ASS_TIME_RE.fullmatch(text.strip())
+    if not match:
+        return None
+
+    hours,minutes,seconds,fraction=match.groups() # Fractions are usually centiseconds, but not always.
+    return ((int(hours)*60+int(minutes))*60+int(seconds))*1000+int(((fraction or '')+'000')[:3])
+
+def format_srt_time(milliseconds):
+    seconds,milliseconds=divmod(milliseconds,1000)
+    minutes,seconds=divmod(seconds,60)
+    hours,minutes=divmod(minutes,60)
+    return '{:02d}:{:02d}:{:02d},{:03d}'.format(hours,minutes,seconds,milliseconds)
+
+def ass_text_to_srt(text):
+    """Returns the plain text of an ASS event, or None if it is a drawing.
+    """
+    if '{' in text:
+        if ASS_DRAWING_RE.search(text):
+            return None
+
+        text=ASS_TAG_RE.sub('',text)
+
+    text=text.replace('\\N','\n').replace('\\n','\n').replace('\\h',' ')
+    return '\n'.join(line.strip() for line in text.split('\n') if line.strip())
+
+def ass2srt(in_filename,out_filename=None,encoding='utf-8'):
+    """Converts an ASS/SSA subtitle file to SRT, returning the name of the new file, or None if it has no dialogues.
+
+    The file is read line by line, with the fields of each event located by the Format line of its
+    Events section. Override tags and drawings are removed, identical events (e.g. from several
+    layers) are written once, and events repeating the text of an overlapping or adjacent one (e.g.
+    signs typeset frame by frame) are joined.
+    """
+    if not out_filename:
+        out_filename=os.path.splitext(in_filename)[0]+'.srt'
+
+    events=[]
+    texts={} # Converted texts, as many events repeat them.
+    fields=ASS_DEFAULT_FORMAT
+    positions=[fields.index(field) for field in ('start','end','text')]
+    in_events=False
+    with open(in_filename,'r',encoding=encoding,errors='replace') as in_file:
+        for line in in_file:
+            line=line.strip().lstrip('\ufeff')
+            if line.startswith('['):
+                in_events=line.lower() == '[events]'
+
+            elif not in_events:
+                continue
+
+            elif line.startswith('Format:'):
+                fields=[field.strip().lower() for field in line[7:].split(',')]
+                if 'text' not in fields or 'start' not in fields or 'end' not in fields:
+                    fields=ASS_DEFAULT_FORMAT
+
+                positions=[fields.index(field) for field in ('start','end','text')]
+
+            elif line.startswith('Dialogue:'):
+                values=line[9:].split(',',len(fields)-1) # Text is the last field, and may have commas.
+                if len(values) < len(fields):
+                    continue
+
+                start=parse_ass_time(values[positions[0]])
+                end=parse_ass_time(values[positions[1]])
+                raw_text=values[positions[2]]
+                if raw_text not in texts:
+                    texts[raw_text]=ass_text_to_srt(raw_text)
+
+                text=texts[raw_text]
+                if start is None or end is None or end <= start or not text:
+                    continue
+
+                events.append((start,end,text))
+
+    if not events:
+        return None
+
+    events=sorted(set(events))
+    merged=[]
+    last_by_text={} # Last merged event of each text.
+    for start,end,text in events:
+        previous=last_by_text.get(text)
+        if previous and start <= previous[1]:
+            previous[1]=max(previous[1],end)
+
+        else:
+            last_by_text[text]=[start,end,text]
+            merged.append(last_by_text[text])
+
+    with open(out_filename,'w',encoding='utf-8',buffering=1<<16) as out_file:
+        for counter,(start,end,text) in enumerate(merged,1):
+            out_file.write('{:d}\n{} --> {}\n{}\n\n'.format(counter,format_srt_time(start),format_srt_time(end),text))
+
+    return out_filename
+
+def run_ffmpeg(cmd,progress=None,progress_key=0):
+    """Runs an ffmpeg command line, feeding progress (a Progress object) if given. Returns the exit code.
+    """
+    if not progress:
+        return process_runner.run(cmd).returncode
+
+    cmd=cmd[:1] + ['-progress', 'pipe:1', '-nostats'] + cmd[1:]
+    values={}
+    def parse_progress_line(line):
+        key,separator,value=line.strip().partition('=')
+        if not separator:
+            return
+
+        values[key]=value.strip()
+        if key == 'progress': # Last line of each block.
+            progress.update(progress_key,dict(values))
+            values.clear()
+
+    return process_runner.run(cmd,line_callback=parse_progress_line).returncode
+
+def ffmpeg_has_filter(filter_name):
+    cproc = process_runner.run(["ffmpeg", "-hide_banner", "-filters"], process_runner.get_probe_timeout(), subprocess.PIPE, subprocess.DEVNULL)
+    return any(line.split()[1:2] == [filter_name] for line in cproc.stdout.split('\n'))
+
+def count_frames(filename):
+    cproc = process_runner.run(["ffprobe", "-v", "error", "-select_streams", "v:0", "-count_packets", "-show_entries", "stream=nb_read_packets", "-of", "csv=p=0", filename], None, subprocess.PIPE, subprocess.DEVNULL)
+    return parse_number(cproc.stdout.strip(),int)
+
+def measure_quality(distorted,reference,filter_name):
+    """Returns the SSIM ('ssim') or VMAF ('libvmaf') score of distorted compared to reference, or None.
+    """
+    cproc = process_runner.run(["ffmpeg", "-nostdin", "-i", distorted, "-i", reference, "-lavfi", "[0:v][1:v]{}".format(filter_name), "-f", "null", "-"], None, subprocess.DEVNULL, subprocess.PIPE)
+    pattern=r'VMAF score: ([\d.]+)' if filter_name == 'libvmaf' else r'SSIM .*All:([\d.]+)'
+    match=re.search(pattern,cproc.stderr)
+    if not match:
+        return None
+
+    return float(match.group(1))
+
+def format_eta(seconds):
+    if seconds is None:
+        return '-'
+
+    return '{:d}:{:02d}:{:02d}'.format(int(seconds//3600),int(seconds%3600//60),int(seconds%60))
+
+def prometheus_label(value):
+    return value.replace('\\','\\\\').replace('"','\\"').replace('\n','\\n')
+
+def probe_media(filename):
+    """Returns a MediaInfo object for filename, or None if ffprobe can not read it.
+    """
+    probe_data=run_ffprobe(filename)
+    if probe_data is None:
+        return None
+
+    return MediaInfo(probe_data)
+
+def run_ffprobe(filename):
+    """Returns the ffprobe stream and format data of filename as a dictionary, or None if ffprobe can not read it.
+    """
+    cproc = process_runner.run(["ffprobe", "-v", "error", "-print_format", "json", "-show_streams", "-show_format", filename], process_runner.get_probe_timeout(), subprocess.PIPE, subprocess.DEVNULL)
+    if cproc.returncode:
+        return None
+
+    try:
+        return json.loads(cproc.stdout)
+
+    except ValueError:
+        return None
+
+def default_cache_dir():
+    return os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'),'.cache'),'transcode2H265')
+
+def default_journal_filename(inputs,watched_directories=None,resume=False):
+    """Returns the journal of the batch of the given inputs and watched directories, so batches running at the same time do not share it.
+
+    The last batch started is pointed by the file 'latest', and it is returned when resuming without inputs.
+    Journals not used for 30 days are removed.
+    """
+    directory=os.path.join(default_cache_dir(),'journals')
+    latest_filename=os.path.join(directory,'latest')
+    if resume and not inputs and not watched_directories:
+        try:
+            with open(latest_filename) as latest_file:
+                return latest_file.read().strip()
+
+        except OSError:
+            return os.path.join(directory,'none.jsonl') # Reported as no batch to resume.
+
+    import hashlib
+    batch=[os.path.abspath(filename) for filename in inputs]+['watch:'+os.path.abspath(watched) for watched in watched_directories or []]
+    filename=os.path.join(directory,hashlib.sha1(json.dumps(batch).encode('utf-8')).hexdigest()[:16]+'.jsonl')
+    try:
+        os.makedirs(directory,exist_ok=True)
+        for entry in os.scandir(directory):
+            if entry.name.endswith('.jsonl') and entry.stat().st_mtime < time.time()-30*86400:
+                os.remove(entry.path)
+
+        with open(latest_filename+'.tmp.{:d}'.format(os.getpid()),'w') as latest_file:
+            latest_file.write(filename+'\n')
+
+        os.replace(latest_filename+'.tmp.{:d}'.format(os.getpid()),latest_filename)
+
+    except OSError:
+        pass
+
+    return filename
+
+def normalize_language(language):
+    if not language or "unk" in language.lower() or "und" in language.lower():
+        return None
+
+    return language
+
+def parse_number(value,number_type):
+    try:
+        return number_type(value)
+
+    except (TypeError,ValueError):
+        return None
+
+def parse_size(text):
+    """Returns the bytes of a size like 700M, 4.5G or 800000K. Plain numbers are MiB.
+    """
+    match=re.fullmatch(r'\s*([0-9]*\.?[0-9]+)\s*([KMGT]?)i?B?\s*',text,re.IGNORECASE)
+    if not match or not float(match.group(1)):
+        raise argparse.ArgumentTypeError(_('invalid size: {}').format(text))
+
+    return int(float(match.group(1))*1024**' KMGT'.index(match.group(2).upper() or 'M'))
+
+def parse_ionice(text):
+    """Returns the (class, level) tuple of an ionice option like idle or best-effort:7.
+    """
+    name,separator,level=text.partition(':')
+    classes={'realtime': 1, 'best-effort': 2, 'idle': 3}
+    if name not in classes or (separator and level not in [str(n) for n in range(8)]):
+        raise argparse.ArgumentTypeError(_('invalid I/O scheduling class: {}').format(text))
+
+    return classes[name],int(level) if separator else None
+
+def parse_extensions(text):
+    """Returns the set of extensions, with their dot and in lower case, of a list like mkv,mp4,.AVI.
+    """
+    extensions={'.'+extension.strip().lstrip('.').lower() for extension in text.split(',') if extension.strip()}
+    if not extensions:
+        raise argparse.ArgumentTypeError(_('invalid list of extensions: {}').format(text))
+
+    return extensions
+
+def parse_cpu_list(text):
+    """Returns the set of processors of a list like 0-3,8.
+    """
+    cpus=set()
+    try:
+        for part in text.split(','):
+            first,separator,last=part.partition('-')
+            cpus.update(range(int(first),int(last if separator else first)+1))
+
+    except ValueError:
+        raise argparse.ArgumentTypeError(_('invalid processor list: {}').format(text))
+
+    if not cpus:
+        raise argparse.ArgumentTypeError(_('invalid processor list: {}').format(text))
+
+    if hasattr(os,'sched_getaffinity'):
+        cpus&=os.sched_getaffinity(0) # Otherwise taskset fails to run the programs.
+        if not cpus:
+            raise argparse.ArgumentTypeError(_('none of the processors is available: {}').format(text))
+
+    return cpus
+
+def parse_rate(rate_string):
+    """Converts ffprobe rates like '24000/1001' to float.
+    """
+    if not rate_string or '/' not in rate_string:
+        return parse_number(rate_string,float)
+
+    numerator,denominator=rate_string.split('/')
+    numerator,denominator=parse_number(numerator,float),parse_number(denominator,float)
+    if not numerator or not denominator:
+        return None
+
+    return numerator/denominator
+
+def crop_sample_times(duration,samples,spread,seed=None):
+    """Returns evenly spaced times covering the central spread fraction of duration.
+
+    If seed is given, every time is moved randomly (but reproducibly) inside its own slot.
+    """
+    start=duration*(1-spread)/2
+    slot=duration*spread/samples
+    times=[start+slot*(n+0.5) for n in range(samples)]
+    if seed is not None:
+        import random
+        generator=random.Random(seed)
+        times=[sample_time+generator.uniform(-slot/4,slot/4) for sample_time in times]
+
+    return times
+
+def detect_crop(filename,sample_times,window=1,video_index=0):
+    """Returns the most frequent crop rectangle found by cropdetect, on stream video_index, in windows starting at sample_times.
+
+    All the windows are decoded by a single ffmpeg process, without writing any output file.
+    """
+    cmd=["ffmpeg", "-nostdin", "-hide_banner"]
+    for sample_time in sample_times:
+        cmd+=["-ss", "{:.3f}".format(sample_time), "-t", str(window), "-i", filename]
+
+    cmd+=["-filter_complex", ";".join("[{0:d}:{1:d}]cropdetect[crop{0:d}]".format(n,video_index) for n in range(len(sample_times)))]
+    for n in range(len(sample_times)):
+        cmd+=["-map", "[crop{:d}]".format(n), "-f", "null", "-"]
+
+    cproc = process_runner.run(cmd, process_runner.get_probe_timeout()*len(sample_times), subprocess.DEVNULL, subprocess.PIPE)
+    crop_counter=collections.Counter(match.group(1) for match in re.finditer(r'cropdetect.*crop=(\d+:\d+:\d+:\d+)',cproc.stderr))
+    if not crop_counter:
+        return None
+
+    return crop_counter.most_common(1)[0][0]
+
+def random_string(length = 10):
+    import random
+    import string
+    rand_string = ''
+    for letter in random.sample(string.ascii_lowercase + string.ascii_uppercase + string.digits, length):
+        rand_string += letter
+
+    return rand_string
+
+def transcode_video(video,args,reporter,threads,quiet,telemetry=None,journal=None):
+    """Transcodes a single video with the command line options, and reports the result.
+
+    Returns the final state of the video: 'done', 'skipped' or 'failed'.
+    """
+    state='failed'
+    print(_('\n==== Transcoding file {} ====').format(video.get_filename()))
+    video.set_transcoding_options(args.preset, args.crf, args.replace, args.avlang, args.slang, args.filename_postfix, threads, args.auto_crop, quiet, args.chunks, args.crop_samples, args.crop_spread, args.crop_seed, args.mux, telemetry, args.max_size_ratio, journal, args.srt, args.audio_codec, args.audio_bitrate, args.jobs > 1, args.target_size, args.target_bitrate, args.scratch_dir)
+    try:
+        if video.transcode():
+            state='done'
+            reporter.count_file_ok()
+            if journal:
+                journal.record(video.get_filename(),'done',output=video.get_output_filename())
+
+        elif video.get_skip_reason():
+            state='skipped'
+            reporter.add_skipped_file(video.get_filename(),video.get_skip_reason())
+            if journal:
+                journal.record(video.get_filename(),'skipped',reason=video.get_skip_reason())
+            
+        else:
+            reporter.add_file_with_errors(video.get_filename())
+            if journal:
+                journal.record(video.get_filename(),'failed')
+
+    except KeyboardInterrupt:
+        reporter.add_file_with_errors(video.get_filename()) # Its processes were killed, see ProcessRunner.
+        raise
+
+    finally:
+        video.clean() # Always clean, not only in success, please...
+        reporter.add_file_record(video.get_report(),state)
+        
+    print(75*'=')
+    return state
+
+def check_video(filename,args,cache,reporter,journal=None,video=None):
+    """Probes filename, unless its Video is given, and returns the Video if it is to be transcoded, reporting it otherwise.
+    """
+    if args.resume and journal and journal.is_done(filename):
+        print(_("File {} was already transcoded in the resumed batch.").format(filename))
+        reporter.add_skipped_file(filename,_('done in the resumed batch'))
+        journal.record(filename,'done')
+        return None
+
+    if journal:
+        journal.record(filename,'probing')
+
+    if video is None:
+        video=Video(filename,cache)
+
+    if not video.is_ok():
+        sys.stderr.write(_("File {} is not a proper video file.\n").format(filename))
+        reporter.add_ignored_file(filename)
+        if journal:
+            journal.record(filename,'skipped',reason='not a video')
+
+        return None
+
+    previous_output=None
+    if not args.force and not args.benchmark:
+        previous_output=video.get_previous_output()
+
+    if previous_output:
+        sys.stderr.write(_("File {} was already transcoded to {}.\n").format(filename,previous_output))
+        reporter.add_skipped_file(filename,_('already transcoded to {}').format(previous_output))
+        if journal:
+            journal.record(filename,'done',output=previous_output)
+
+        return None
+
+    skip_reason=None
+    if not args.force and not args.benchmark:
+        skip_reason=video.check_skip_rules(args.filename_postfix,args.min_bpp)
+
+    if skip_reason:
+        sys.stderr.write(_("Skipping file {}: {}.\n").format(filename,skip_reason))
+        reporter.add_skipped_file(filename,skip_reason)
+        if journal:
+            journal.record(filename,'skipped',reason=skip_reason)
+
+        return None
+
+    if journal:
+        journal.record(filename,'queued')
+
+    return video
+
+def is_video_candidate(filename,extensions,postfix):
+    """Returns True for the files found in input or watched directories that are worth probing: with one of extensions and not hidden, temporary nor outputs of this script.
+    """
+    name=os.path.basename(filename)
+    root,ext=os.path.splitext(name)
+    if name.startswith('.') or '_tmp_' in name or root.endswith(postfix):
+        return False # Hidden files, and temporary files and outputs of this script.
+
+    return ext.lower() in extensions
+
+def find_video_files(paths,extensions,min_size,postfix):
+    """Returns the files given in paths and the video files inside the directories given, recursively.
+
+    Files in directories are only taken if their extension is in extensions, they are at least min_size bytes
+    and they do not look like outputs or temporary files of this script, so no time is spent probing them.
+    The same file reached through several paths (hard links, symbolic links...) is returned once.
+    """
+    found=[]
+    seen=set() # (st_dev, st_ino) of the files and directories already found.
+    ignored=0
+    for path in paths:
+        try:
+            stat=os.stat(path)
+
+        except OSError:
+            found.append(path) # It is reported as not a video later.
+            continue
+
+        if (stat.st_dev,stat.st_ino) in seen:
+            continue
+
+        seen.add((stat.st_dev,stat.st_ino))
+        if not os.path.isdir(path):
+            found.append(path)
+            continue
+
+        directories=[path]
+        while directories:
+            directory=directories.pop()
+            try:
+                with os.scandir(directory) as iterator:
+                    entries=sorted(iterator,key=lambda entry: entry.name)
+
+            except OSError as error:
+                sys.stderr.write(_("WARNING: Directory {} can not be read: {}\n").format(directory,error))
+                continue
+
+            subdirectories=[]
+            for entry in entries:
+                try:
+                    is_dir=entry.is_dir()
+                    if not is_dir and not is_video_candidate(entry.name,extensions,postfix):
+                        ignored+=1
+                        continue
+
+                    stat=entry.stat() # Following symbolic links.
+
+                except OSError:
+                    continue # Broken links, or removed meanwhile.
+
+                if (stat.st_dev,stat.st_ino) in seen:
+                    continue
+
+                seen.add((stat.st_dev,stat.st_ino))
+                if is_dir:
+                    subdirectories.append(entry.path)
+
+                elif stat.st_size >= min_size:
+                    found.append(entry.path)
+
+                else:
+                    ignored+=1
+
+            directories+=reversed(subdirectories) # So they are walked in order.
+
+    if ignored:
+        print(_('{:d} files in the directories given are ignored by their extension, name or size.').format(ignored))
+
+    return found
+
+def probe_videos(filenames,cache,workers):
+    """Yields the Video of each one of filenames, in the same order, probing up to workers files at the same time.
+    """
+    if workers == 1:
+        for filename in filenames:
+            yield Video(filename,cache)
+
+        return
+
+    import concurrent.futures
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        pending=collections.deque()
+        filenames=iter(filenames)
+        for filename in filenames:
+            pending.append(executor.submit(Video,filename,cache))
+            if len(pending) >= workers*4: # Not all at once, the videos are used while others are probed.
+                yield pending.popleft().result()
+
+        while pending:
+            yield pending.popleft().result()
+
+def watch_directories(args,cache,reporter,scheduler,telemetry,journal):
+    """Transcodes the files that appear in the --watch directories, once they stop changing, until interrupted.
+    """
+    watcher=DirectoryWatcher(args.watch,args.poll_interval)
+    settling={} # filename: (size, mtime_ns, time since they are unchanged)
+    handled={} # filename: (size, mtime_ns) when it was handled.
+    status_server=None
+    if args.status_port:
+        status_server=create_status_server(args.status_port,lambda: {'watching': args.watch, 'inotify': watcher.uses_inotify(), 'settling': sorted(settling), 'jobs': scheduler.get_status(), 'files': reporter.get_counts(), 'batch': telemetry.get_batch_status()})
+
+    interrupted=False
+    print(_('Watching {} for new video files ({}). Press Ctrl+C to stop.').format(', '.join(args.watch),_('inotify') if watcher.uses_inotify() else _('polling')))
+    try:
+        while True:
+            for filename in watcher.wait_for_changes(1):
+                if is_video_candidate(filename,args.extensions,args.filename_postfix) and filename not in settling:
+                    settling[filename]=(None,None,time.time())
+
+            now=time.time()
+            for filename,(size,mtime_ns,since) in list(settling.items()):
+                try:
+                    stat=os.stat(filename)
+
+                except OSError:
+                    del settling[filename] # Removed or moved away.
+                    continue
+
+                if (stat.st_size,stat.st_mtime_ns) != (size,mtime_ns):
+                    settling[filename]=(stat.st_size,stat.st_mtime_ns,now)
+
+                elif now-since >= args.settle:
+                    del settling[filename]
+                    if handled.get(filename) == (size,mtime_ns):
+                        continue
+
+                    handled[filename]=(size,mtime_ns)
+                    video=check_video(filename,args,cache,reporter,journal)
+                    if video:
+                        telemetry.add_duration(video.get_duration())
+                        scheduler.submit(video)
+
+    except KeyboardInterrupt:
+        print(_('\nStopping, the running jobs are cancelled...'))
+        interrupted=True
+
+    finally:
+        watcher.close()
+        if status_server:
+            status_server.shutdown()
+
+        scheduler.stop(cancel=interrupted) # The queued videos are not started.
+
+def create_status_server(port,get_status):
+    """Starts serving the JSON status returned by get_status at http://127.0.0.1:port/, and returns the server.
+    """
+    import http.server
+    server=http.server.ThreadingHTTPServer(('127.0.0.1',port),type('StatusRequestHandler',(StatusRequestHandler,http.server.BaseHTTPRequestHandler),{}))
+    server.get_status=get_status
+    threading.Thread(target=server.serve_forever,daemon=True).start()
+    return server
+
+def is_tcp_address(address):
+    return not address.startswith('/') and not address.startswith('.') and ':' in address
+
+def parse_tcp_address(address):
+    host,port=address.rsplit(':',1)
+    return host or '127.0.0.1',int(port)
+
+def create_coordinator_server(address):
+    """Returns a threaded server listening at address, that is 'host:port' or the path of a Unix socket.
+    """
+    import socketserver
+    handler=type('CoordinatorRequestHandler',(CoordinatorRequestHandler,socketserver.StreamRequestHandler),{})
+    if is_tcp_address(address):
+        socketserver.ThreadingTCPServer.allow_reuse_address=True
+        server=socketserver.ThreadingTCPServer(parse_tcp_address(address),handler)
+
+    else:
+        if os.path.exists(address):
+            os.remove(address) # Left by a previous coordinator.
+
+        server=socketserver.ThreadingUnixStreamServer(address,handler)
+
+    server.daemon_threads=True
+    return server
+
+def connect_to_coordinator(address,timeout=60):
+    """Returns a socket connected to the coordinator at address, retrying for timeout seconds.
+    """
+    import socket
+    deadline=time.time()+timeout
+    while True:
+        try:
+            if is_tcp_address(address):
+                return socket.create_connection(parse_tcp_address(address))
+
+            connection=socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+            connection.connect(address)
+            return connection
+
+        except OSError:
+            if time.time() > deadline:
+                raise
+
+            time.sleep(1)
+
+def run_worker(args,cache,reporter):
+    """Transcodes the videos leased by the coordinator at args.worker, with its transcoding options, until the batch is done.
+    """
+    connection=connect_to_coordinator(args.worker)
+    stream=connection.makefile('rw',encoding='utf-8')
+    lock=threading.Lock() # Requests of the heartbeat thread and of the job must not be mixed.
+    def request(message):
+        with lock:
+            stream.write(json.dumps(message)+'\n')
+            stream.flush()
+            line=stream.readline()
+            if not line:
+                raise ConnectionError(_('The coordinator closed the connection.'))
+
+            return json.loads(line)
+
+    import socket
+    answer=request({'op': 'hello', 'worker': '{}:{:d}'.format(socket.gethostname(),os.getpid())})
+    for option,value in answer['options'].items():
+        setattr(args,option,value) # All the workers use the transcoding options of the coordinator.
+
+    heartbeat_interval=answer['lease_time']/3
+    while True:
+        try:
+            answer=request({'op': 'lease'})
+
+        except OSError:
+            print(_('The coordinator is gone, assuming the batch is done.'))
+            break
+
+        job=answer.get('job')
+        if not job:
+            if answer.get('done'):
+                break
+
+            time.sleep(1) # Other workers are still working, and their videos may be queued again.
+            continue
+
+        start_time=time.time()
+        finished=threading.Event()
+        def send_heartbeats():
+            while not finished.wait(heartbeat_interval):
+                try:
+                    request({'op': 'heartbeat', 'id': job['id']})
+
+                except OSError:
+                    return # The result can not be sent either, it is handled then.
+
+        def commit_output():
+            try:
+                return request({'op': 'commit', 'id': job['id']}).get('ok')
+
+            except OSError:
+                return False
+
+        def send_progress(event,status,batch_status):
+            try:
+                request({'op': 'progress', 'id': job['id'], 'event': event, 'status': status})
+
+            except OSError:
+                pass # The transcoding goes on, its result is sent if the coordinator comes back.
+
+        heartbeat_thread=threading.Thread(target=send_heartbeats,daemon=True)
+        heartbeat_thread.start()
+        details={}
+        try:
+            video=Video(job['file'],cache)
+            if not video.is_ok():
+                state='failed'
+
+            else:
+                video.set_output_check(commit_output) # The video may have been leased to another worker meanwhile.
+                telemetry=Telemetry(video.get_duration(),False,callback=send_progress)
+                state=transcode_video(video,args,reporter,args.threads,False,telemetry)
+                details={'output': video.get_output_filename(), 'reason': video.get_skip_reason(), 'record': video.get_report()}
+
+        except Exception as error:
+            sys.stderr.write(_("ERROR: Unexpected failure transcoding {}: {}\n").format(job['file'],error))
+            state='failed'
+
+        finally:
+            finished.set()
+            heartbeat_thread.join()
+
+        try:
+            answer=request(dict(details,op='result',id=job['id'],state=state,elapsed=round(time.time()-start_time,1)))
+            if not answer.get('ok'):
+                sys.stderr.write(_("WARNING: The coordinator rejected the result of {}, its lease was lost.\n").format(job['file']))
+
+        except OSError:
+            print(_('The coordinator is gone, assuming the batch is done.'))
+            break
+
+    connection.close()
+
+def run_script():
+    """Function to be called to actually run the script.
+    """
+    initial_time=time.time()
+    parser=argparse.ArgumentParser(description=_("This program transcode video files to H265 and AAC in MKV format. Subtitles, if present, are automatically detected and soft subbed into the corresponding output files."), add_help=False)
+    parser.add_argument('video', nargs='*', help=_('Input video file(s), or directories where video files are searched recursively.'))
+    parser.add_argument('-h','--help', action='help', help=_("Show this help message and exit."))
+    parser.add_argument('-p', '--preset', default='medium', help=_('X265 preset [default: %(default)s].'))
+    parser.add_argument('-q','--crf', type=int, default=28, help=_('CRF value [default: %(default)s]. Determines the output video quality. Smaller values gives better qualities and bigger file sizes, bigger values result in less quality and smaller file sizes. Default value results in a nice quality/size ratio. CRF values should be in the range of 1 to 50.'))
+    parser.add_argument('-r', '--replace-original-video-file', action='store_true', default=False, dest='replace', help=_('If set then original video files will be erased after transcoding. WARNING: deleted files can not be easily recovered!'))
+    parser.add_argument('-l','--avlang', default='eng', help=_('Default audio language for MKV files obtained (used only if the original stream languages fail to be determined) [default: %(default)s].'))
+    parser.add_argument('-L', '--slang', default='spa', help=_('Default subtitle language of soft-subbed subtitles (only used if original subtitle languages fail to be determined) [default: %(default)s].'))
+    parser.add_argument('-x', '--filename-postfix', default='_h265', help=_('Postfix to be added to newly created H.265 video files [default: %(default)s].'))
+    parser.add_argument('-t', '--threads', type=int, default=0, help=_('Indicates the number of processor cores the script will use. 0 indicates to use as many as possible [default: %(default)s].'))
+    parser.add_argument('-j', '--jobs', type=int, default=1, help=_('Number of video files to transcode at the same time. The processor cores given with -t are split among the running jobs, and the longest videos are transcoded first [default: %(default)s].'))
+    parser.add_argument('-k', '--chunks', type=int, default=1, help=_('Split the video stream of each file in this number of pieces at keyframes and encode them in parallel, which shortens a lot the transcoding time of single long videos. Audio is still encoded once for the whole file. 1 disables this mode [default: %(default)s].'))
+    parser.add_argument('-f', '--force', action='store_true', default=False, help=_('Transcode the input videos even if they are already HEVC, have a low bit rate (see --min-bpp) or their output file already exists.'))
+    parser.add_argument('--min-bpp', type=float, default=0, help=_('Skip input videos with less bits per pixel (video bit rate divided by width, height and frame rate) than this value, as they will hardly shrink. 0 disables this check [default: %(default)s].'))
+    parser.add_argument('--extensions', type=parse_extensions, default=','.join(VIDEO_EXTENSIONS), help=_('Comma separated extensions of the files taken as videos in the input and watched directories [default: %(default)s].'))
+    parser.add_argument('--min-size', type=parse_size, default=0, help=_('Ignore the files in the input directories smaller than this, e.g. 50M (MiB if no unit is given), like samples or trailers [default: no minimum].'))
+    parser.add_argument('--probe-workers', type=int, default=4, help=_('Number of input files probed at the same time [default: %(default)s].'))
+    parser.add_argument('--max-size-ratio', type=float, default=1.0, help=_('Discard the output, keeping the original video, if its size is bigger than this fraction of the original size. 0 disables this check [default: %(default)s].'))
+    parser.add_argument('-c', '--auto-crop', action='store_true', default=False, help=_('Turn on autocrop function. WARNING: Use with caution as some video files has variable width horizontal (and vertical) black bars, in those cases you will probably lose data.')) 
+    parser.add_argument('-m', '--mux', choices=['ffmpeg', 'mkvmerge'], default='ffmpeg', help=_('Program used to put the subtitles into the output files. ffmpeg writes the final file directly while transcoding, mkvmerge needs an intermediate file and is used anyway when some subtitles can not be handled by ffmpeg [default: %(default)s].'))
+    parser.add_argument('--audio-codec', choices=['aac', 'opus'], default='aac', help=_('Codec for the audio streams that are transcoded. AAC and Opus streams with a reasonable bit rate are copied as they are, and all the audio streams are kept [default: %(default)s].'))
+    parser.add_argument('--audio-bitrate', type=int, default=None, help=_('Bit rate per channel, in kb/s, of the transcoded audio streams. AAC and Opus streams above 1.5 times this are transcoded too [default: 96 for AAC, 64 for Opus].'))
+    parser.add_argument('--target-size', type=parse_size, default=None, help=_('Encode the video in two passes to make each output about this size, e.g. 700M or 4.5G (MiB if no unit is given), instead of using a CRF. The first pass is kept in the cache to retry with other sizes faster.'))
+    parser.add_argument('--target-bitrate', type=int, default=None, help=_('Encode the video in two passes with this bit rate, in kb/s, instead of using a CRF.'))
+    parser.add_argument('--srt', action='store_true', help=_('Convert ASS/SSA subtitles, internal or external, to SRT, for players that do not support them. Styles and positions are lost.'))
+    parser.add_argument('--crop-samples', type=int, default=5, help=_('Number of points of the video where black bars are looked for with -c [default: %(default)s].'))
+    parser.add_argument('--crop-spread', type=float, default=0.9, help=_('Fraction of the video duration, centered in the middle of it, where the crop sample points are evenly spread [default: %(default)s].'))
+    parser.add_argument('--crop-seed', type=int, default=None, help=_('If given, the crop sample points are moved randomly inside their own portion of the video, using this seed so results are reproducible.'))
+    parser.add_argument('--progress-log', default=None, help=_('File where the progress of the transcoding (fps, speed, bitrate, ETA of each file and of the whole batch) is appended as JSON lines.'))
+    parser.add_argument('--prometheus-textfile', default=None, help=_('File where the progress is kept as Prometheus metrics, e.g. for the node_exporter textfile collector.'))
+    parser.add_argument('--benchmark', action='store_true', default=False, help=_('Do not transcode, but encode short clips of the input videos (or a synthetic clip if there are none) with every combination of --benchmark-presets, --benchmark-crfs and --benchmark-threads, and report the speed, processor time and bit rate of each one.'))
+    parser.add_argument('--benchmark-presets', default=None, help=_('Comma separated x265 presets for --benchmark [default: the -p value].'))
+    parser.add_argument('--benchmark-crfs', default=None, help=_('Comma separated CRF values for --benchmark [default: the -q value].'))
+    parser.add_argument('--benchmark-threads', default=None, help=_('Comma separated thread counts for --benchmark [default: the -t value].'))
+    parser.add_argument('--benchmark-duration', type=int, default=10, help=_('Duration in seconds of the --benchmark clips [default: %(default)s].'))
+    parser.add_argument('--benchmark-quality', action='store_true', default=False, help=_('Also measure SSIM and VMAF in --benchmark, if the installed ffmpeg supports them. This is slow.'))
+    parser.add_argument('--benchmark-report', default=None, help=_('File where the --benchmark results are saved, as JSON if it ends in .json or as CSV otherwise.'))
+    parser.add_argument('--journal', default=None, help=_('File where the state of every file of the batch is recorded, to be able to resume it with --resume [default: a file in ~/.cache/transcode2H265/journals named after the input files, so batches running at the same time do not share it].'))
+    parser.add_argument('--resume', action='store_true', default=False, help=_('Resume the batch recorded in the journal: temporary files left by an interruption are removed and the files already transcoded are skipped. If no video files (nor --journal) are given, the last batch started is resumed.'))
+    parser.add_argument('-w', '--watch', action='append', default=[], metavar='DIR', help=_('Keep running and transcode the video files that appear in this directory (can be given several times). New files are only taken once their size and modification time stop changing (see --settle). Stop with Ctrl+C.'))
+    parser.add_argument('--settle', type=float, default=30, help=_('Seconds a new file in a watched directory must stay unchanged before it is transcoded [default: %(default)s].'))
+    parser.add_argument('--poll-interval', type=float, default=10, help=_('Seconds between scans of the watched directories when inotify is not available [default: %(default)s].'))
+    parser.add_argument('--status-port', type=int, default=0, help=_('With --watch, serve the status of the watched directories and the jobs as JSON at http://127.0.0.1:STATUS_PORT/. 0 disables it [default: %(default)s].'))
+    parser.add_argument('--coordinator', default=None, metavar='ADDRESS', help=_('Do not transcode, but lease the input videos to the workers that connect to ADDRESS, that is HOST:PORT or the path of a Unix socket. Workers use the transcoding options of the coordinator.'))
+    parser.add_argument('--worker', default=None, metavar='ADDRESS', help=_('Transcode the videos leased by the coordinator at ADDRESS, one at a time, until its batch is done. Paths must be the same in the coordinator and the workers.'))
+    parser.add_argument('--lease-time', type=float, default=60, help=_('Seconds without news from a worker after which the coordinator queues its video again [default: %(default)s].'))
+    parser.add_argument('--max-attempts', type=int, default=3, help=_('Number of times the coordinator leases a video before giving up on it [default: %(default)s].'))
+    parser.add_argument('--report', default=None, help=_('File where the sizes, compression ratio and time spent in every stage (probe, subtitles, crop, encode and mux) of each file are saved, as JSON if it ends in .json or as CSV otherwise.'))
+    parser.add_argument('--profile', default=None, help=_('Profile the Python code of the script and save the statistics in this file, to be read with pstats, or as text if it ends in .txt.'))
+    parser.add_argument('--scratch-dir', default=None, help=_('Directory for the temporary files, e.g. in a fast local disk when the videos are in a network share. The outputs are moved next to the inputs once complete. By default the temporary files are written next to the inputs.'))
+    parser.add_argument('--nice', type=int, default=0, help=_('Niceness added to the external programs, from 0 to 19, so the transcoding does not slow down other work [default: %(default)s].'))
+    parser.add_argument('--ionice', type=parse_ionice, default=None, help=_('I/O scheduling class of the external programs: idle, best-effort or realtime, optionally followed by :LEVEL (0 to 7), e.g. best-effort:7. Needs the ionice program.'))
+    parser.add_argument('--cpu-affinity', type=parse_cpu_list, default=None, help=_('Processors the external programs may run on, e.g. 0-3,8. Needs the taskset program.'))
+    parser.add_argument('--stall-timeout', type=float, default=600, help=_('Seconds without output nor disk reads or writes after which an external program is considered hung and killed. 0 disables this check [default: %(default)s].'))
+    parser.add_argument('--probe-timeout', type=float, default=120, help=_('Maximum seconds for each probe of a file (ffprobe, crop detection...) [default: %(default)s].'))
+    parser.add_argument('--no-cache', action='store_true', default=False, help=_('Do not read nor update the cache of probe results, crop dimensions and transcoding outcomes kept in ~/.cache/transcode2H265. Files already transcoded in a previous run are only skipped when the cache is used.'))
+    parser.add_argument('--cache-size', type=int, default=10000, help=_('Maximum number of video files remembered in the cache [default: %(default)s].'))
+    parser.add_argument('--cache-data-size', type=parse_size, default=10*2**30, help=_('Maximum size of the first pass analyses kept in the cache by --target-size and --target-bitrate, e.g. 20G (MiB if no unit is given). The least recently used are removed first [default: 10G].'))
+    parser.add_argument('-v', '--version', action='version', version='3.2.7', help=_("Show program's version number and exit.")) # I need to use this explicit help message here (together with setting add_help=False when creating the parser) to be able to proper translate the version help message (when required). All other messages are translated OK, but not this one. With this edit now everything is OK.
+    
+    args=parser.parse_args()
+
+    if args.crf < 1 or args.crf > 50:
+        parser.error(_('CRF values should be in the range of 1 to 50.'))
+        
+    if args.threads < 0:
+        parser.error(_('The number of threads must be 0 or positive.'))
+
+    if args.jobs < 1:
+        parser.error(_('The number of simultaneous jobs must be 1 or greater.'))
+
+    if args.probe_workers < 1:
+        parser.error(_('The number of probe workers must be 1 or greater.'))
+
+
+    if args.audio_bitrate is not None and args.audio_bitrate < 1:
+        parser.error(_('The audio bit rate must be positive.'))
+
+    if args.target_size and args.target_bitrate:
+        parser.error(_('--target-size and --target-bitrate can not be used together.'))
+
+    if (args.target_size or args.target_bitrate) and args.chunks > 1:
+        parser.error(_('Two pass encoding (--target-size or --target-bitrate) can not be used with --chunks.'))
+
+    if args.target_bitrate is not None and args.target_bitrate < 1:
+        parser.error(_('The target bit rate must be positive.'))
+
+    if args.scratch_dir and not (os.path.isdir(args.scratch_dir) and os.access(args.scratch_dir,os.W_OK)):
+        parser.error(_('The scratch directory {} does not exist or is not writable.').format(args.scratch_dir))
+
+    if args.nice < 0 or args.nice > 19:
+        parser.error(_('The niceness must be in the range of 0 to 19.'))
+
+    if args.stall_timeout < 0 or args.probe_timeout <= 0:
+        parser.error(_('The stall timeout must be 0 or positive, and the probe timeout positive.'))
+
+    process_runner.configure(args.nice,args.ionice,args.cpu_affinity,args.stall_timeout,args.probe_timeout)
+    signal.signal(signal.SIGINT,process_runner.handle_signal)
+    signal.signal(signal.SIGTERM,process_runner.handle_signal) # Stop as with Ctrl+C.
+
+    if args.chunks < 1:
+        parser.error(_('The number of chunks must be 1 or greater.'))
+
+    if args.min_bpp < 0:
+        parser.error(_('The minimum bits per pixel must be 0 or positive.'))
+
+    if args.max_size_ratio < 0:
+        parser.error(_('The maximum size ratio must be 0 or positive.'))
+
+    for directory in args.watch:
+        if not os.path.isdir(directory):
+            parser.error(_('{} is not a directory.').format(directory))
+
+    if args.settle < 0 or args.poll_interval <= 0:
+        parser.error(_('The settle time must be 0 or positive, and the poll interval positive.'))
+
+    if args.coordinator and (args.worker or args.watch):
+        parser.error(_('--coordinator can not be used with --worker or --watch.'))
+
+    if args.lease_time <= 0 or args.max_attempts < 1:
+        parser.error(_('The lease time must be positive, and the maximum attempts 1 or greater.'))
+
+    if args.crop_samples < 1:
+        parser.error(_('The number of crop samples must be 1 or greater.'))
+
+    if args.crop_spread <= 0 or args.crop_spread > 1:
+        parser.error(_('The crop spread must be greater than 0 and not greater than 1.'))
+
+    if args.cache_size < 1:
+        parser.error(_('The cache size must be 1 or greater.'))
+
+    known_presets = ["ultrafast", "superfast", "veryfast", "faster", "fast", "medium", "slow", "slower", "veryslow"]
+    if args.preset not in known_presets:
+        parser.error(_('Unknown preset "{}".\nValid values are:\n\t{}\n').format(args.preset, '\n\t'.join(known_presets)))
+
+    if not args.video and not args.benchmark and not args.resume and not args.watch and not args.worker:
+        parser.error(_('the following arguments are required: video'))
+
+    if args.benchmark:
+        benchmark_presets=args.benchmark_presets.split(',') if args.benchmark_presets else [args.preset]
+        for preset in benchmark_presets:
+            if preset not in known_presets:
+                parser.error(_('Unknown preset "{}".\nValid values are:\n\t{}\n').format(preset, '\n\t'.join(known_presets)))
+
+        try:
+            benchmark_crfs=[int(crf) for crf in args.benchmark_crfs.split(',')] if args.benchmark_crfs else [args.crf]
+            benchmark_threads=[int(threads) for threads in args.benchmark_threads.split(',')] if args.benchmark_threads else [args.threads]
+
+        except ValueError:
+            parser.error(_('--benchmark-crfs and --benchmark-threads must be comma separated integers.'))
+
+        if any(crf < 1 or crf > 50 for crf in benchmark_crfs):
+            parser.error(_('CRF values should be in the range of 1 to 50.'))
+
+        if any(threads < 0 for threads in benchmark_threads):
+            parser.error(_('The number of threads must be 0 or positive.'))
+
+        if args.benchmark_duration < 1:
+            parser.error(_('The benchmark duration must be 1 or greater.'))
+
+    check_the_required_programs(not args.no_cache) # Only when there is work to do, not for -h or wrong arguments.
+    cache=None
+    if not args.no_cache:
+        import sqlite3
+        try:
+            cache=Cache(os.path.join(default_cache_dir(),'cache.sqlite'),args.cache_size,args.cache_data_size)
+
+        except (OSError,sqlite3.Error) as error:
+            sys.stderr.write(_("WARNING: The cache can not be used: {}\n").format(error))
+
+    profiler=None
+    if args.profile:
+        profiler=Profiler()
+        profiler.enable()
+        atexit.register(profiler.save,args.profile) # Also after the early returns of the other modes.
+
+    reporter=Reporter()
+    if args.worker:
+        try:
+            run_worker(args,cache,reporter)
+
+        except KeyboardInterrupt:
+            print(_('\nStopping, the running jobs are cancelled...')) # The coordinator queues its video again.
+
+        if cache:
+            cache.close()
+
+        reporter.print_final_report()
+        if args.report:
+            reporter.write_report(args.report,round(time.time()-initial_time,3))
+
+        print(_('Work finished in {}.').format(print_duration(time.time()-initial_time)))
+        exit(process_runner.get_exit_status())
+
+    journal=None
+    if not args.benchmark:
+        if not args.journal:
+            args.journal=default_journal_filename(args.video,args.watch,args.resume)
+
+        journal=Journal(args.journal)
+        if args.resume:
+            if not journal.load():
+                sys.stderr.write(_("ERROR: There is no batch to resume in {}.\n").format(args.journal))
+                exit(1)
+
+            journal.clean_orphans()
+            if not args.video:
+                args.video=journal.get_files()
+
+    args.video=find_video_files(args.video,args.extensions,args.min_size,args.filename_postfix)
+    if journal:
+        journal.start(args.video)
+
+    is_done=lambda filename: args.resume and journal and journal.is_done(filename)
+    videos=probe_videos([filename for filename in args.video if not is_done(filename)],cache,args.probe_workers)
+    scheduler=Scheduler(args.jobs,args.threads,reporter)
+    file_counter=0
+    try:
+        for filename in args.video:
+            file_counter+=1        
+            print(_('\n==== Checking file {:d}/{:d} ====').format(file_counter,len(args.video)))
+            video=check_video(filename,args,cache,reporter,journal,None if is_done(filename) else next(videos))
+            if video:
+                scheduler.add_video(video)
+
+    except KeyboardInterrupt:
+        videos.close() # Waits for the probes being run, the new ones are not started.
+        print(_('\nStopping, the running jobs are cancelled...'))
+
+    if process_runner.get_exit_status():
+        pass # Interrupted, nothing more is started.
+
+    elif args.benchmark:
+        benchmark=Benchmark(benchmark_presets,benchmark_crfs,benchmark_threads,args.benchmark_duration,args.benchmark_quality)
+        try:
+            benchmark.run(scheduler.get_videos())
+
+        except KeyboardInterrupt:
+            print(_('\nStopping, the running jobs are cancelled...'))
+
+        if args.benchmark_report:
+            benchmark.write_report(args.benchmark_report)
+
+        if cache:
+            cache.close()
+
+        print(_('Benchmark finished in {}.').format(print_duration(time.time()-initial_time)))
+        exit(process_runner.get_exit_status())
+
+    elif args.coordinator:
+        shared_options={option: getattr(args,option) for option in ('preset','crf','replace','avlang','slang','filename_postfix','auto_crop','crop_samples','crop_spread','crop_seed','mux','max_size_ratio','srt','audio_codec','audio_bitrate','target_size','target_bitrate','chunks')}
+        videos=sorted(scheduler.get_videos(),key=lambda video: video.get_duration(),reverse=True)
+        coordinator=Coordinator(videos,shared_options,reporter,journal,args.lease_time,args.max_attempts,args.progress_log)
+        status_server=None
+        if args.status_port:
+            status_server=create_status_server(args.status_port,coordinator.get_status)
+
+        try:
+            coordinator.run(args.coordinator)
+
+        except KeyboardInterrupt:
+            print(_('\nStopping, the workers lose their leases...'))
+
+        if status_server:
+            status_server.shutdown()
+
+    else:
+        telemetry=Telemetry(scheduler.get_total_duration(),args.jobs == 1,args.progress_log,args.prometheus_textfile)
+        job_function=lambda video,threads,quiet: transcode_video(video,args,reporter,threads,quiet,telemetry,journal)
+        if profiler and (args.jobs > 1 or args.watch):
+            job_function=profiler.wrap(job_function) # Jobs run in their own threads, otherwise in the main one, already profiled.
+
+        if args.watch:
+            scheduler.start(job_function)
+            watch_directories(args,cache,reporter,scheduler,telemetry,journal)
+
+        else:
+            try:
+                scheduler.run(job_function)
+
+            except KeyboardInterrupt:
+                print(_('\nStopping, the running jobs are cancelled...'))
+            
+    if cache:
+        cache.close()
+
+    reporter.print_final_report()
+        
+    final_time=time.time()
+    if args.report:
+        reporter.write_report(args.report,round(final_time-initial_time,3))
+    
+    print(_('Work finished in {}.').format(print_duration(final_time-initial_time)))
+    if process_runner.get_exit_status():
+        print(_('Exiting after an interruption.'))
+        exit(process_runner.get_exit_status())
+
     print(_('Exiting OK.'))
     
 ## Running the script